@@ -1,10 +1,16 @@
+import copy
+import os
+import queue
+import threading
 from collections import deque
+from contextlib import nullcontext
 import torch as T
 from torch._C import dtype
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
+from Profiler import profiler
 
 # Deep Q network
 class DQN(nn.Module):
@@ -32,11 +38,20 @@ class DQN(nn.Module):
 
 # The car agent
 class Agent:
-    def __init__(self, gamma, epsilon, lr, inputs, nActions, batchSize, memSize=100000, epsilonFinal=0.05, epsilonDecrease=5e-4):
+    def __init__(self, gamma, epsilon, lr, inputs, nActions, batchSize, memSize=100000, epsilonFinal=0.05, epsilonDecrease=5e-4, memPath=None,
+                 prioritized=False, alpha=0.6, beta=0.4, betaIncrease=1e-5, prefetch=0, script=False,
+                 updatesPerStep=1.0, targetEvery=None, asyncLearning=False, maxOwed=1000, quantized=False, compact=False):
         self.DQN = DQN(lr, inputs, 512, 512, nActions)
         self.DQNext = DQN(lr, inputs, 512, 512, nActions)
         self.DQNext.load_state_dict(self.DQN.state_dict())
         self.actionSpace = [i for i in range(nActions)]
+        self.nActions = nActions
+        # The network used for acting, a TorchScript copy shares its parameters so it never goes stale
+        # while a quantized one is an int8 copy on the CPU, refreshed whenever the target network is synced
+        self.quantized = quantized
+        self.policy = T.jit.script(self.DQN) if script else self.DQN
+        self.policyDevice = self.DQN.device
+        self.updatePolicy()
 
         self.gamma = gamma
         self.epsilon = epsilon
@@ -47,85 +62,634 @@ class Agent:
         # self.memCounter = 0
 
         # self.memory = deque(maxlen=self.memSize)
-        self.memory = ReplayMemory(maxlen=self.memSize, data=[[[8], np.float32], [[8], np.float32], [None, np.float32], [None, np.bool], [None, np.int32]])
+        data = [[[8], np.float32], [[8], np.float32], [None, np.float32], [None, np.bool], [None, np.int32]]
+        # compact stores each observation once in float16, see CompactReplayMemory
+        self.prioritized = prioritized
+        if self.prioritized and compact:
+            raise ValueError("The compact replay memory does not support prioritized replay")
+        if self.prioritized:
+            self.memory = PrioritizedReplayMemory(maxlen=self.memSize, data=data, path=memPath, alpha=alpha, beta=beta, betaIncrease=betaIncrease)
+        elif compact:
+            self.memory = CompactReplayMemory(maxlen=self.memSize, data=data, path=memPath)
+        else:
+            self.memory = ReplayMemory(maxlen=self.memSize, data=data, path=memPath)
+
+        # With prefetch > 0, that many batches are sampled ahead on a background thread once learning starts
+        self.prefetch = prefetch
+        self.prefetcher = None
+
+        # Every stored transition owes updatesPerStep gradient steps, paid by catchUp or by a background learner
+        # thread when asyncLearning, which holds the environment back once more than maxOwed steps are owed.
+        # With targetEvery, the target network follows every targetEvery gradient steps
+        self.updatesPerStep = updatesPerStep
+        self.targetEvery = targetEvery
+        self.maxOwed = maxOwed
+        self.learnSteps = 0
+        self.owed = 0.0
+        self.memoryLock = threading.Lock()
+        # Held for a whole gradient step, so checkpoints see the networks and the optimizer from the same step
+        # Taken before memoryLock when both are needed
+        self.learnLock = threading.Lock()
+        self.owedCondition = threading.Condition()
+        self.learner = None
+        self.checkpointer = None
+        if asyncLearning:
+            self.learner = threading.Thread(target=self.learnLoop, daemon=True)
+            self.learner.start()
      
     def store(self, observation):
-        self.memory.append(observation)
+        with self.memoryLock:
+            self.memory.append(observation)
+        self.owe(1)
+
+    # Store a whole batch of transitions at once, given column wise like ReplayMemory.buffer
+    def storeMany(self, columns):
+        with self.memoryLock:
+            self.memory.extend(columns)
+        self.owe(len(columns[0]))
+
+    # Nothing is owed until there is enough memory to learn from
+    def owe(self, steps):
+        if self.memory.len < self.batchSize:
+            return
+        with self.owedCondition:
+            self.owed += steps * self.updatesPerStep
+            self.owedCondition.notify_all()
+            if self.learner is not None:
+                self.owedCondition.wait_for(lambda: self.owed <= self.maxOwed or self.learner is None)
+
+    # Do the gradient steps owed so far, when nothing learns in the background
+    def catchUp(self):
+        if self.learner is not None:
+            return
+        while self.owed >= 1:
+            self.owed -= 1
+            self.learn()
+
+    def learnLoop(self):
+        while True:
+            with self.owedCondition:
+                self.owedCondition.wait_for(lambda: self.owed >= 1 or self.learner is None)
+                if self.learner is None:
+                    return
+                self.owed -= 1
+                self.owedCondition.notify_all()
+            self.learn()
     
     def choose(self, observation):
         rand = np.random.random()
         if rand < self.epsilon:
             action = np.random.choice(self.actionSpace)
         else:
-            state = T.tensor([observation]).to(self.DQN.device)
-            actions = self.DQN(state)
+            state = T.from_numpy(np.array([observation], dtype=np.float32)).to(self.policyDevice)
+            with T.inference_mode():
+                actions = self.policy(state)
             action = T.argmax(actions).item()
 
         return action
+
+    # Epsilon greedy actions for a whole batch of observations [n, inputs] with one forward pass
+    # epsilon can be overridden with a number or one value per observation, say for actors exploring differently
+    def chooseMany(self, observations, epsilon=None):
+        observations = np.asarray(observations, dtype=np.float32)
+        n = len(observations)
+        explore = np.random.random(n) < (self.epsilon if epsilon is None else epsilon)
+        actions = np.random.randint(self.nActions, size=n)
+        if not explore.all():
+            with T.inference_mode():
+                greedy = self.policy(T.from_numpy(observations).to(self.policyDevice)).argmax(dim=1).cpu().numpy()
+            actions = np.where(explore, actions, greedy)
+        return actions
     
     def learn(self):
         if self.memory.len < self.batchSize:
             return
-        self.DQN.optimizer.zero_grad()
-
-        # Make batch
-        # maxMem = min(self.memCounter, self.memSize)
-        # batchIndices = np.random.choice(maxMem, self.batchSize, replace=False)
-        batchArange = np.arange(self.batchSize, dtype=np.int32)
-        # batch = np.array([self.memory[i] for i in batchIndices])
-
-        batch = self.memory.sample(self.batchSize)
-
-        stateBatch = T.tensor(batch[0]).to(self.DQN.device)
-        newStateBatch = T.tensor(batch[1]).to(self.DQN.device)
-        rewardBatch = T.tensor(batch[2]).to(self.DQN.device)
-        terminalBatch = T.tensor(batch[3]).to(self.DQN.device)
-        actionBatch = batch[4]
-
-        qVals = self.DQN(stateBatch)[batchArange, actionBatch]
-        qNext = self.DQNext(newStateBatch)
-        qNext[terminalBatch] = 0.0
-        qTarget = rewardBatch + self.gamma * T.max(qNext, dim=1)[0]
-
-        loss = self.DQN.loss(qTarget, qVals).to(self.DQN.device)
-        loss.backward()
-        self.DQN.optimizer.step()
+        with profiler.phase("Agent.learn"), self.learnLock:
+            if self.prefetch and self.prefetcher is None:
+                self.prefetcher = Prefetcher(self.sampleBatch, self.prefetch)
+            self.DQN.optimizer.zero_grad()
+
+            # Make batch
+            batchArange = np.arange(self.batchSize, dtype=np.int32)
+            with profiler.phase("Agent.learn/batch"):
+                if self.prefetcher is not None:
+                    batch = self.prefetcher.get()
+                else:
+                    batch = self.sampleBatch()
+            (stateBatch, newStateBatch, rewardBatch, terminalBatch, actionBatch), indices, weights = batch
+
+            with profiler.phase("Agent.learn/forward"):
+                qVals = self.DQN(stateBatch)[batchArange, actionBatch]
+                qNext = self.DQNext(newStateBatch)
+                qNext[terminalBatch] = 0.0
+                qTarget = rewardBatch + self.gamma * T.max(qNext, dim=1)[0]
+
+                if self.prioritized:
+                    # Importance sampling weighted loss, and the TD errors become the new priorities
+                    tdError = qTarget - qVals
+                    loss = (weights * tdError ** 2).mean()
+                    with self.memoryLock:
+                        self.memory.updatePriorities(indices, tdError.detach().abs().cpu().numpy())
+                else:
+                    loss = self.DQN.loss(qTarget, qVals).to(self.DQN.device)
+            with profiler.phase("Agent.learn/backward"):
+                loss.backward()
+                self.DQN.optimizer.step()
+
+            self.learnSteps += 1
+            if self.targetEvery and self.learnSteps % self.targetEvery == 0:
+                self.updateNetwork()
     
+    # Sample a batch and move it to the device, sharing memory with the sampled numpy arrays where possible
+    # Returns the tensors, and the indices and importance sampling weights when prioritized
+    def sampleBatch(self):
+        with self.memoryLock:
+            if self.prioritized:
+                batch, indices, weights = self.memory.sample(self.batchSize)
+            else:
+                batch = self.memory.sample(self.batchSize)
+
+        with profiler.phase("Agent.sampleBatch/toDevice"):
+            tensors = [self.toDevice(column) for column in batch[:4]] + [batch[4]]
+        if self.prioritized:
+            return tensors, indices, self.toDevice(weights)
+        return tensors, None, None
+
+    def toDevice(self, array):
+        tensor = T.from_numpy(array)
+        if self.DQN.device.type == 'cuda':
+            return tensor.pin_memory().to(self.DQN.device, non_blocking=True)
+        return tensor
+
+    # Stop the learner, prefetching and checkpoint threads, if there are any
+    def close(self):
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+            self.checkpointer = None
+        if self.learner is not None:
+            learner = self.learner
+            with self.owedCondition:
+                self.learner = None
+                self.owedCondition.notify_all()
+            learner.join()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
     def updateEpsilon(self):
         self.epsilon = self.epsilon - self.epsilonDec if self.epsilon > self.epsilonFinal else self.epsilonFinal
     
     def updateNetwork(self):
         self.DQNext.load_state_dict(self.DQN.state_dict())
+        self.updatePolicy()
+
+    def updatePolicy(self):
+        if self.quantized:
+            self.policy = quantizedPolicy(self.DQN)
+            self.policyDevice = self.policy.device
     
     def save(self, path):
         T.save(self.DQN.state_dict(), path)
 
+    # Save the whole training state to the directory path: both networks, the optimizer, epsilon, the step counters,
+    # the replay memory and whatever is in extra (episode counters, scores...). Everything is copied here and
+    # written to disk on a background thread, and only the memory items added since the last checkpoint are copied
+    def checkpoint(self, path, extra=None, wait=False):
+        if self.checkpointer is None or self.checkpointer.path != path:
+            if self.checkpointer is not None:
+                self.checkpointer.close()
+            self.checkpointer = Checkpointer(path, self.memory)
+
+        with self.learnLock, self.memoryLock:
+            memory = self.checkpointer.snapshot(self.memory)
+            state = {'DQN': cpuCopy(self.DQN.state_dict()), 'DQNext': cpuCopy(self.DQNext.state_dict()),
+                     'optimizer': copy.deepcopy(self.DQN.optimizer.state_dict()), 'epsilon': self.epsilon,
+                     'learnSteps': self.learnSteps, 'owed': self.owed, 'extra': copy.deepcopy(extra)}
+            if self.prioritized:
+                state['priorities'] = self.memory.tree.get(np.arange(self.memory.len))
+                state['beta'] = self.memory.beta
+                state['maxPriority'] = self.memory.maxPriority
+        self.checkpointer.write(state, memory)
+        if wait:
+            self.checkpointer.wait()
+
+    # Load a checkpoint written by checkpoint and return its extra
+    def restore(self, path):
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        state = T.load(os.path.join(path, 'agent.pt'), map_location='cpu', weights_only=False)
+        with self.learnLock:
+            self.DQN.load_state_dict(state['DQN'])
+            self.DQNext.load_state_dict(state['DQNext'])
+            self.DQN.optimizer.load_state_dict(state['optimizer'])
+            self.epsilon = state['epsilon']
+            self.learnSteps = state['learnSteps']
+            self.owed = state['owed']
+            self.updatePolicy()
+
+        saved = ReplayMemory(self.memory.maxlen, self.memory.layout, path=os.path.join(path, 'memory'))
+        counter, length = state['memory']
+        with self.memoryLock:
+            for column, savedColumn in zip(self.memory.buffer, saved.buffer):
+                column[:length] = savedColumn[:length]
+            self.memory.counter = counter
+            self.memory.len = length
+            if self.prioritized:
+                self.memory.tree.update(np.arange(length), state['priorities'])
+                self.memory.beta = state['beta']
+                self.memory.maxPriority = state['maxPriority']
+        return state['extra']
+
+    def waitForCheckpoint(self):
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+
+# Largest input the int8 policy is given. Activations are quantized with one scale for the whole batch, so a single
+# huge observation (a ray that sees nothing, or one kept at the float16 limit by the compact memory) would leave no
+# resolution for the other ones. Ray distances on the 966 x 768 screen stay well below it
+QUANTIZED_INPUT_MAX = 2048.0
+
+# An int8 copy of net for acting on the CPU: the weights of the Linear layers are quantized once here and the
+# activations on the fly, from inputs clipped to QUANTIZED_INPUT_MAX. The optimizer is left behind, the copy is only
+# for inference
+def quantizedPolicy(net):
+    policy = copy.deepcopy(net, {id(net.optimizer): None}).cpu()
+    policy.device = T.device('cpu')
+    policy = T.ao.quantization.quantize_dynamic(policy.eval(), {nn.Linear}, dtype=T.qint8, inplace=True)
+    policy.register_forward_pre_hook(clipInputs)
+    return policy
+
+def clipInputs(module, inputs):
+    return (inputs[0].clamp(max=QUANTIZED_INPUT_MAX),)
+
+# Fraction of the observations [n, inputs] on which policy picks the same greedy action as the float net
+# Each observation is scored on its own, the way an actor acts on it, so the others in the batch do not change its scale
+def greedyAgreement(net, policy, observations):
+    observations = T.from_numpy(np.asarray(observations, dtype=np.float32))
+    with T.inference_mode():
+        expected = net(observations.to(net.device)).argmax(dim=1).cpu()
+        actual = T.cat([policy(observation[None]) for observation in observations]).argmax(dim=1)
+    return (expected == actual).float().mean().item()
+
+def cpuCopy(stateDict):
+    return {name: tensor.detach().cpu().clone() for name, tensor in stateDict.items()}
+
+# Writes Agent checkpoints on a background thread, one at a time in order. The replay memory is mirrored in a
+# memory mapped ReplayMemory under path/memory, so each checkpoint only writes the items added since the last one
+class Checkpointer:
+    def __init__(self, path, memory):
+        self.path = path
+        self.saved = ReplayMemory(memory.maxlen, memory.layout, path=os.path.join(path, 'memory'))
+        self.savedAdded = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Copy of the memory items to write: the new ones, or all of them the first time or once all were overwritten
+    # Plus the one just before them, where a compact memory writes the transition continuing from the last new state
+    def snapshot(self, memory):
+        new = memory.added - self.savedAdded + 1 if self.savedAdded is not None else memory.maxlen
+        if new >= memory.len:
+            indices = np.arange(memory.len)
+        else:
+            indices = (memory.counter - new + np.arange(new)) % memory.maxlen
+        self.savedAdded = memory.added
+        return indices, [column[indices] for column in memory.buffer], memory.counter, memory.len
+
+    def write(self, state, memory):
+        self.queue.put((state, memory))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, (indices, rows, counter, length) = item
+            for column, row in zip(self.saved.buffer, rows):
+                column[indices] = row
+            self.saved.counter = counter
+            self.saved.len = length
+            self.saved.flush()
+
+            # The state goes last and replaces the old one in one go, so it never points at items not written yet
+            state['memory'] = (counter, length)
+            T.save(state, os.path.join(self.path, 'agent.pt.tmp'))
+            os.replace(os.path.join(self.path, 'agent.pt.tmp'), os.path.join(self.path, 'agent.pt'))
+            self.queue.task_done()
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+# Calls sample on a background thread to keep up to depth results ready, so sampling overlaps the gradient step
+class Prefetcher:
+    def __init__(self, sample, depth=2):
+        self.sample = sample
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop.is_set():
+            batch = self.sample()
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        return self.queue.get()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+# With a path, every column lives in a memory mapped .npy file in that directory (under /dev/shm it stays in
+# shared memory), so processes opening the same path share one buffer and it reopens intact after a restart.
+# Processes appending to the same buffer should pass the same multiprocessing lock
 class ReplayMemory:
-    def __init__(self, maxlen, data):
+    def __init__(self, maxlen, data, path=None, lock=None):
         self.maxlen = maxlen
+        self.path = path
+        self.lock = lock if lock is not None else nullcontext()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
         self.buffer = []
-        self.len = 0
-        for i in data:
+        for n, i in enumerate(data):
             if i[0] == None:
-                self.buffer.append(np.zeros(maxlen, dtype=i[1]))
+                self.buffer.append(self.column('column{}'.format(n), (maxlen,), i[1]))
             else:
-                self.buffer.append(np.zeros((maxlen, *i[0]), dtype=i[1]))
+                self.buffer.append(self.column('column{}'.format(n), (maxlen, *i[0]), i[1]))
+        self.layout = data
         self.data = len(data)
-        self.counter = 0
-    
+        # counter and len, kept in an array so they are shared and saved along with the columns
+        self.meta = self.column('meta', (2,), np.int64)
+        # Items appended by this process, for finding what changed since a checkpoint
+        self.added = 0
+
+    def column(self, name, shape, dtype):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+
+        file = os.path.join(self.path, name + '.npy')
+        if not os.path.exists(file):
+            return np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
+        array = np.load(file, mmap_mode='r+')
+        if array.shape != shape or array.dtype != np.dtype(dtype):
+            raise ValueError("{} holds a {} {} column, expected {} {}".format(file, array.shape, array.dtype, shape, np.dtype(dtype)))
+        return array
+
+    @property
+    def counter(self):
+        return int(self.meta[0])
+
+    @counter.setter
+    def counter(self, value):
+        self.meta[0] = value
+
+    @property
+    def len(self):
+        return int(self.meta[1])
+
+    @len.setter
+    def len(self, value):
+        self.meta[1] = value
+
     def append(self, item):
-        for i in range(self.data):
-            self.buffer[i][self.counter] = item[i]
-        
-        self.counter = (self.counter + 1) % self.maxlen
-        self.len = min(self.len + 1, self.maxlen)
+        with self.lock:
+            counter = self.counter
+            for i in range(self.data):
+                self.buffer[i][counter] = item[i]
+
+            self.counter = (counter + 1) % self.maxlen
+            self.len = min(self.len + 1, self.maxlen)
+            self.added += 1
+
+    # Append n items at once, given as one array per column
+    def extend(self, columns):
+        n = len(columns[0])
+        with self.lock:
+            indices = (self.counter + np.arange(n)) % self.maxlen
+            for i in range(self.data):
+                self.buffer[i][indices] = columns[i]
 
+            self.counter = (self.counter + n) % self.maxlen
+            self.len = min(self.len + n, self.maxlen)
+            self.added += n
+
+    # Write memory mapped columns back to disk
+    def flush(self):
+        if self.path is not None:
+            for column in self.buffer + [self.meta]:
+                column.flush()
+
+    # Distinct random items in O(size): draw with replacement and redraw the (rare) repeats
     def sample(self, size):
-        choices = np.random.choice(range(self.len), size=size, replace=False)
+        with profiler.phase("ReplayMemory.sample"):
+            return self.sampleItems(size)
+
+    def sampleItems(self, size):
+        length = self.len
+        choices = np.random.randint(0, length, size=size)
+        while True:
+            unique, first = np.unique(choices, return_index=True)
+            if len(unique) == min(size, length):
+                break
+            repeats = np.setdiff1d(np.arange(size), first)
+            choices[repeats] = np.random.randint(0, length, size=len(repeats))
         return [self.buffer[i][choices] for i in range(self.data)]
 
+# Replay memory storing each observation once, in a narrower type, for about a third of the space: slot k holds
+# the state of transition k and its new state is the observation in slot k + 1, the state of the next transition
+# when the episode goes on. Whenever it does not (a new episode, or a chunk from another actor), the new state gets
+# a slot of its own that starts no transition. Every append leaves its new state in the last slot written, so the
+# next one can start from there. Actions and terminals are uint8, and sample converts back to the same columns as
+# ReplayMemory from the logical layout data
+class CompactReplayMemory(ReplayMemory):
+    def __init__(self, maxlen, data, path=None, lock=None, stateType=np.float16):
+        self.logical = data
+        self.stateType = np.dtype(stateType)
+        # Distances too big for the state type are kept at its largest value instead of overflowing
+        self.stateMax = np.finfo(self.stateType).max if self.stateType.kind == 'f' else np.iinfo(self.stateType).max
+        storage = [[data[0][0], stateType], [None, data[2][1]], [None, np.uint8], [None, np.uint8], [None, np.bool_]]
+        ReplayMemory.__init__(self, maxlen, storage, path, lock)
+        self.observations, self.rewards, self.terminals, self.actions, self.valid = self.buffer
+
+    # Same as extend for a single row, without the array overhead
+    def append(self, item):
+        state, newState, reward, terminal, action = item
+        state = np.minimum(state, self.stateMax).astype(self.stateType)
+        with self.lock:
+            counter = self.counter
+            last = (counter - 1) % self.maxlen
+            if self.len > 0 and not self.valid[last] and not self.terminals[(last - 1) % self.maxlen] and (self.observations[last] == state).all():
+                slot, used = last, 1
+            else:
+                slot, used = counter, 2
+            new = (slot + 1) % self.maxlen
+
+            self.observations[new] = np.minimum(newState, self.stateMax)
+            self.terminals[new] = 0
+            self.valid[new] = False
+            self.observations[slot] = state
+            self.rewards[slot] = reward
+            self.terminals[slot] = terminal
+            self.actions[slot] = action
+            self.valid[slot] = True
+
+            self.counter = (counter + used) % self.maxlen
+            self.len = min(self.len + used, self.maxlen)
+            self.added += used
+
+    # Rows continuing from the previous new state only take one slot, the others two
+    def extend(self, columns):
+        states, newStates, rewards, terminals, actions = columns
+        n = len(states)
+        states = np.minimum(np.asarray(states), self.stateMax).astype(self.stateType)
+        newStates = np.minimum(np.asarray(newStates), self.stateMax).astype(self.stateType)
+        terminals = np.asarray(terminals, dtype=bool)
+        with self.lock:
+            counter = self.counter
+            last = (counter - 1) % self.maxlen
+            follows = np.empty(n, dtype=bool)
+            follows[0] = self.len > 0 and not self.valid[last] and not self.terminals[(last - 1) % self.maxlen] and np.array_equal(self.observations[last], states[0])
+            follows[1:] = ~terminals[:-1] & (states[1:] == newStates[:-1]).all(axis=1)
+
+            ends = np.cumsum(2 - follows)
+            stateSlots = (counter + ends - 2) % self.maxlen
+            newSlots = (counter + ends - 1) % self.maxlen
+
+            # New state slots first, the next row may start from one of them
+            self.observations[newSlots] = newStates
+            self.terminals[newSlots] = 0
+            self.valid[newSlots] = False
+            self.observations[stateSlots] = states
+            self.rewards[stateSlots] = rewards
+            self.terminals[stateSlots] = terminals
+            self.actions[stateSlots] = actions
+            self.valid[stateSlots] = True
+
+            used = int(ends[-1])
+            self.counter = (counter + used) % self.maxlen
+            self.len = min(self.len + used, self.maxlen)
+            self.added += used
+
+    # Distinct random transitions: draw slots until there are size distinct ones starting a transition, and keep
+    # a random size of them. Or all of them with repeats while there are fewer than size
+    def sampleItems(self, size):
+        length = self.len
+        if length < 4 * size:
+            starts = np.flatnonzero(self.valid[:length])
+            if len(starts) <= size:
+                return self.items(np.random.choice(starts, size=size))
+
+        choices = np.zeros(0, dtype=np.int64)
+        while len(choices) < size:
+            draws = np.random.randint(0, length, size=2 * (size - len(choices)))
+            choices = np.unique(np.concatenate([choices, draws[self.valid[draws]]]))
+        return self.items(np.random.permutation(choices)[:size])
+
+    def items(self, indices):
+        return [self.observations[indices].astype(self.logical[0][1]), self.observations[(indices + 1) % self.maxlen].astype(self.logical[1][1]),
+                self.rewards[indices], self.terminals[indices].astype(self.logical[3][1]), self.actions[indices].astype(self.logical[4][1])]
+
+# Array based sum tree: leaf i of the last level holds priority i and every node the sum of its children
+# Updates and sampling walk one level at a time for the whole batch, so both are O(batch * log n) numpy work
+class SumTree:
+    def __init__(self, capacity):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.leaves + np.asarray(indices)]
+
+    def update(self, indices, priorities):
+        nodes = self.leaves + np.asarray(indices)
+        if nodes.size == 0:
+            return
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    # The leaf each value in [0, total) lands on, going left while the value fits in the left child's sum
+    def find(self, values):
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaves:
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= np.where(right, left, 0)
+            nodes = 2 * nodes + right
+        return nodes - self.leaves
+
+# Replay memory sampling items in proportion to priority ** alpha, new items getting the highest priority so far
+# sample also returns the indices to update the priorities of and the importance sampling weights
+class PrioritizedReplayMemory(ReplayMemory):
+    def __init__(self, maxlen, data, path=None, lock=None, alpha=0.6, beta=0.4, betaIncrease=1e-5, minPriority=1e-6):
+        ReplayMemory.__init__(self, maxlen, data, path, lock)
+        self.alpha = alpha
+        self.beta = beta
+        self.betaIncrease = betaIncrease
+        self.minPriority = minPriority
+        self.maxPriority = 1.0
+        self.tree = SumTree(maxlen)
+        # A reopened memory starts with everything at the same priority
+        if self.len > 0:
+            self.tree.update(np.arange(self.len), self.maxPriority)
+
+    def append(self, item):
+        with self.lock:
+            counter = self.counter
+        ReplayMemory.append(self, item)
+        self.tree.update([counter], self.maxPriority ** self.alpha)
+
+    def extend(self, columns):
+        with self.lock:
+            indices = (self.counter + np.arange(len(columns[0]))) % self.maxlen
+        ReplayMemory.extend(self, columns)
+        self.tree.update(indices, self.maxPriority ** self.alpha)
+
+    def sample(self, size):
+        with profiler.phase("ReplayMemory.sample"):
+            return self.samplePrioritized(size)
+
+    def samplePrioritized(self, size):
+        # One value from each of size equal slices of the total, so the batch is spread over the whole tree
+        values = (np.arange(size) + np.random.random(size)) * (self.tree.total / size)
+        indices = np.minimum(self.tree.find(values), self.len - 1)
+
+        probabilities = self.tree.get(indices) / self.tree.total
+        weights = (self.len * probabilities) ** -self.beta
+        weights = (weights / weights.max()).astype(np.float32)
+        self.beta = min(1.0, self.beta + self.betaIncrease)
+
+        return [self.buffer[i][indices] for i in range(self.data)], indices, weights
+
+    def updatePriorities(self, indices, errors):
+        priorities = np.maximum(errors, self.minPriority)
+        self.maxPriority = max(self.maxPriority, priorities.max())
+        self.tree.update(indices, priorities ** self.alpha)
+
 # if __name__ == '__main__':
 #     r = ReplayMemory(20, [[8, np.float32], [8, np.float32], [1, np.int32]])    
 #     for i in range(25):
 #         r.append([[j + i for j in range(8)], [j * i for j in range(8)], i])
-#     print(r.buffer, r.sample(10))
\ No newline at end of file
+#     print(r.buffer, r.sample(10))
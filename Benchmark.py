@@ -0,0 +1,202 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import torch as T
+from pygame.math import Vector2
+
+# Rendering benchmarks need a display, fall back to an offscreen one on headless machines
+if "DISPLAY" not in os.environ:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from Environment import MAP, Car, Game, proceduralMap
+from Agent import Agent, ReplayMemory
+
+ACTIONS = [0, 1, 1, 1, 3, 4, 6, 7]
+
+# Time every call separately: throughput and latency percentiles in microseconds
+def measure(function, repeats, warmup=10):
+    for _ in range(warmup):
+        function()
+    times = np.empty(repeats)
+    for k in range(repeats):
+        start = time.perf_counter()
+        function()
+        times[k] = time.perf_counter() - start
+    times *= 1e6
+    return {"calls": repeats, "perSecond": repeats / times.sum() * 1e6, "mean": times.mean(),
+            "p50": np.percentile(times, 50), "p90": np.percentile(times, 90), "p99": np.percentile(times, 99), "max": times.max()}
+
+def mapFor(walls):
+    return MAP if walls == 26 else proceduralMap(walls)
+
+# Game.step, resetting whenever the episode ends, with or without rendering every step
+def benchStep(walls, render, repeats, seed=0):
+    rng = np.random.default_rng(seed)
+    game = Game(mapFor(walls), headless=not render)
+    game.reset()
+
+    def step():
+        game.step(rng.choice(ACTIONS))
+        if render:
+            game.render()
+        if game.done:
+            game.reset()
+    return measure(step, repeats)
+
+def benchSee(walls, repeats, seed=0):
+    rng = np.random.default_rng(seed)
+    game = Game(mapFor(walls), headless=True)
+    caster = game.car.rayCaster
+    pairs = game.gates.map[1:]
+
+    def see():
+        a, b = pairs[rng.integers(len(pairs))]
+        caster.move(Vector2((a[0] + b[0]) / 2, (a[1] + b[1]) / 2), rng.uniform(0, 360))
+        caster.see(game.screen, game.sensors, render=False)
+    return measure(see, repeats)
+
+def benchUpdate(repeats, seed=0):
+    rng = np.random.default_rng(seed)
+    car = Car([100, 50], "car.png", 0)
+
+    def update():
+        car.update(0.015, rng.choice(ACTIONS))
+    return measure(update, repeats)
+
+def transitions(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((n, 8), dtype=np.float32) * 100, rng.random((n, 8), dtype=np.float32) * 100,
+            rng.choice([-50, 0, 50], n).astype(np.float32), rng.random(n) < 0.01, rng.integers(0, 5, n).astype(np.int32)]
+
+# append and sample on a full replay memory of the given size
+def benchMemory(size, batchSize, repeats, compact=False):
+    agent = Agent(gamma=0.99, epsilon=0, lr=0.002, inputs=8, nActions=5, memSize=size, batchSize=batchSize, compact=compact)
+    memory = agent.memory
+    memory.extend(transitions(size))
+    item = [column[0] for column in transitions(1)]
+    return measure(lambda: memory.append(item), repeats), measure(lambda: memory.sample(batchSize), repeats)
+
+def benchLearn(size, batchSize, repeats):
+    agent = Agent(gamma=0.99, epsilon=0, lr=0.002, inputs=8, nActions=5, memSize=size, batchSize=batchSize)
+    agent.storeMany(transitions(size))
+    return measure(agent.learn, repeats)
+
+# Greedy actions for a batch of observations, with the float or the int8 quantized policy
+def benchChoose(batch, quantized, repeats):
+    agent = Agent(gamma=0.99, epsilon=0, lr=0.002, inputs=8, nActions=5, memSize=batch, batchSize=batch, quantized=quantized)
+    observations = transitions(batch)[0]
+    return measure(lambda: agent.chooseMany(observations), repeats)
+
+# Sensing cost of the brute force, vectorized and grid raycasters as the track gets more detailed, one result per
+# raycaster and track size in the same shape as suite's
+def raycastScaling(sizes=(26, 100, 1000, 10000), repeats=200, seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        maps = mapFor(size)
+        brute = Game(maps, vectorized=False, headless=True)
+        vectorized = Game(maps, headless=True)
+        grid = Game(maps, headless=True, gridCell=32)
+
+        # Look around from random spots along the middle of the track
+        pairs = list(zip(maps[0], maps[1]))
+        spots = []
+        for _ in range(repeats):
+            a, b = pairs[rng.integers(1, len(pairs))]
+            spots.append((Vector2((a[0] + b[0]) / 2, (a[1] + b[1]) / 2), rng.uniform(0, 360)))
+
+        walls = len(brute.walls)
+        latency = {}
+        for name, game in (("brute", brute), ("vectorized", vectorized), ("grid", grid)):
+            caster = game.car.rayCaster
+            spot = itertools.cycle(spots)
+
+            def see():
+                pos, angle = next(spot)
+                caster.move(pos, angle)
+                caster.see(game.screen, game.sensors, render=False)
+
+            # The brute force raycaster is too slow to run many times on big tracks
+            slow = name == "brute" and size > 1000
+            stats = measure(see, 10 if slow else repeats, warmup=1 if slow else 10)
+            results.append(dict(stage="RayParticle.see", params={"walls": walls, "raycaster": name}, **stats))
+            latency[name] = stats["p50"]
+        print("{:>6} walls: brute {brute:10.1f} us, vectorized {vectorized:8.1f} us, grid {grid:8.1f} us per see (p50)".format(walls, **latency))
+    return results
+
+# Every stage on its own, one result per stage and parameters
+def suite(walls=(26, 1000), memSizes=(10000, 100000, 1000000), batchSize=32, repeats=1000, render=True):
+    results = []
+
+    def record(stage, stats, **params):
+        results.append(dict(stage=stage, params=params, **stats))
+        print("{:<22} {:<40} {:>12.0f}/s  p50 {:>9.1f} us  p99 {:>9.1f} us".format(stage, json.dumps(params), stats["perSecond"], stats["p50"], stats["p99"]))
+
+    for w in walls:
+        record("Game.step", benchStep(w, False, repeats), walls=w, render=False)
+        if render:
+            record("Game.step", benchStep(w, True, repeats // 4), walls=w, render=True)
+        record("RayParticle.see", benchSee(w, repeats), walls=w)
+    record("Car.update", benchUpdate(repeats))
+    for size in memSizes:
+        append, sample = benchMemory(size, batchSize, repeats)
+        record("ReplayMemory.append", append, memSize=size)
+        record("ReplayMemory.sample", sample, memSize=size, batchSize=batchSize)
+    append, sample = benchMemory(max(memSizes), batchSize, repeats, compact=True)
+    record("ReplayMemory.append", append, memSize=max(memSizes), compact=True)
+    record("ReplayMemory.sample", sample, memSize=max(memSizes), batchSize=batchSize, compact=True)
+    record("Agent.learn", benchLearn(max(memSizes), batchSize, repeats // 4), memSize=max(memSizes), batchSize=batchSize)
+    for batch in (1, 64):
+        for quantized in (False, True):
+            record("Agent.chooseMany", benchChoose(batch, quantized, repeats), batch=batch, quantized=quantized)
+    return results
+
+# Median latency of every stage against an earlier run, flagging the ones that got slower than tolerance allows
+def compare(baseline, results, tolerance=0.25):
+    before = {(r["stage"], json.dumps(r["params"], sort_keys=True)): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        key = (r["stage"], json.dumps(r["params"], sort_keys=True))
+        if key not in before:
+            continue
+        ratio = r["p50"] / before[key]["p50"]
+        flag = "  SLOWER" if ratio > 1 + tolerance else ""
+        print("{:<22} {:<40} p50 {:>9.1f} -> {:>9.1f} us ({:+.0%}){}".format(key[0], key[1], before[key]["p50"], r["p50"], ratio - 1, flag))
+        if flag:
+            regressions.append(r)
+    return regressions
+
+def environment():
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor(), "numpy": np.__version__, "torch": T.__version__, "threads": T.get_num_threads()}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput and latency of the environment, sensing, replay and learning hot paths")
+    parser.add_argument("--walls", type=int, nargs="+", help="track sizes to run the environment stages on, 26 and 1000 by default "
+                        "(26 to 10000 with --scaling)")
+    parser.add_argument("--mem", type=int, nargs="+", default=[10000, 100000, 1000000], help="replay memory sizes")
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=1000)
+    parser.add_argument("--no-render", action="store_true", help="skip the rendered Game.step stage")
+    parser.add_argument("--scaling", action="store_true", help="only compare the raycasters as the track grows")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file, failing on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower a stage may get before it is a regression")
+    args = parser.parse_args()
+
+    if args.scaling:
+        results = raycastScaling(args.walls or (26, 100, 1000, 10000))
+    else:
+        results = suite(args.walls or (26, 1000), args.mem, args.batch, args.repeats, not args.no_render)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(json.load(f), results, args.tolerance):
+                sys.exit(1)
@@ -0,0 +1,149 @@
+import queue
+import sys
+import numpy as np
+import torch as T
+import torch.multiprocessing as mp
+from Environment import Game
+from Agent import Agent, DQN, greedyAgreement, quantizedPolicy
+
+# Ape-X style training: actor processes play their own Game with a copy of the policy and stream
+# transitions to the learner, which owns the replay memory and sends back fresh weights every so often
+
+# Each actor explores with its own fixed epsilon, from very greedy to very random
+def actorEpsilon(rank, nActors, base=0.4, alpha=7):
+    if nActors == 1:
+        return base
+    return base ** (1 + alpha * rank / (nActors - 1))
+
+# Play forever, sending transitions in chunks and picking up new weights between episodes
+# With quantized, the actor acts with an int8 copy of the network, made again from every weights update, until the
+# learner sets floatOnly: smaller but slower, acting on one observation at a time (see learner)
+# Crashes are the footprint box by default, the same crash model as Train.train and Evaluate
+def actor(rank, nActors, transitions, weights, stop, nActions, chunkSize=256, maxSteps=1500, quantized=False, floatOnly=None,
+          collision='box'):
+    T.set_num_threads(1)
+    np.random.seed(rank)
+    env = Game(headless=True, collision=collision)
+    # Actors act on the CPU, many of them must not each open a CUDA context
+    net = DQN(0, env.nInputs, 512, 512, nActions).cpu()
+    net.device = T.device('cpu')
+    net.load_state_dict(weights.get())
+    policy = quantizedPolicy(net) if quantized else net
+    epsilon = actorEpsilon(rank, nActors)
+
+    chunk = []
+    scores = []
+    while not stop.is_set():
+        try:
+            net.load_state_dict(weights.get_nowait())
+            policy = quantizedPolicy(net) if quantized else net
+        except queue.Empty:
+            pass
+        if quantized and floatOnly is not None and floatOnly.is_set():
+            quantized = False
+            policy = net
+
+        state = env.reset()
+        done = False
+        score = 0
+        j = 0
+        while not done and j < maxSteps and not stop.is_set():
+            if np.random.random() < epsilon:
+                action = np.random.randint(nActions)
+            else:
+                with T.no_grad():
+                    action = T.argmax(policy(T.tensor(np.array([state], dtype=np.float32)).to(policy.device))).item()
+            newState, reward, done = env.step(action)
+            chunk.append((state, newState, reward, done, action))
+            score += reward
+            state = newState
+            j += 1
+
+            if len(chunk) == chunkSize:
+                transitions.put((rank, [np.array(column) for column in zip(*chunk)], scores))
+                chunk = []
+                scores = []
+        scores.append(score)
+
+# Own the replay memory, learn from whatever the actors sent and broadcast the weights every syncEvery steps
+# quantized trades actor latency for memory: acting on one observation per call, the int8 copy takes longer than the
+# float network (about 87 against 57 us in Benchmark.py) but holds its weights in a quarter of the memory. How often the
+# quantized actors would act like the float network is checked on the replayed states, and they go back to the float
+# network for good once that drops below minAgreement
+# With compact, the replay memory stores each observation once (see CompactReplayMemory), and collision is the
+# crash model of the actors
+def learner(nActors=4, learnSteps=100000, syncEvery=400, targetEvery=2000, gamma=0.99, lr=0.002, inputs=8, nActions=5,
+            memSize=1000000, batchSize=32, path='./car_model.pt', memPath=None, quantized=False, compact=False,
+            minAgreement=0.95, collision='box'):
+    ctx = mp.get_context('spawn')
+    transitions = ctx.Queue(maxsize=4 * nActors)
+    weights = [ctx.Queue(maxsize=1) for _ in range(nActors)]
+    stop = ctx.Event()
+    floatOnly = ctx.Event()
+
+    brain = Agent(gamma=gamma, epsilon=0, lr=lr, inputs=inputs, nActions=nActions, memSize=memSize, batchSize=batchSize, memPath=memPath, compact=compact)
+    actors = []
+    for rank in range(nActors):
+        weights[rank].put(cpuWeights(brain))
+        actors.append(ctx.Process(target=actor, args=(rank, nActors, transitions, weights[rank], stop, nActions), kwargs={'quantized': quantized, 'floatOnly': floatOnly, 'collision': collision}, daemon=True))
+        actors[-1].start()
+
+    scores = []
+    step = 0
+    try:
+        while step < learnSteps:
+            # Wait only while there is not enough to learn from yet, and never for actors that are all gone
+            try:
+                while True:
+                    waiting = brain.memory.len < batchSize
+                    rank, columns, actorScores = transitions.get(block=waiting, timeout=1 if waiting else None)
+                    brain.storeMany(columns)
+                    scores += actorScores
+            except queue.Empty:
+                if not any(process.is_alive() for process in actors):
+                    raise RuntimeError("All actors died, exit codes {}".format([process.exitcode for process in actors]))
+            if brain.memory.len < batchSize:
+                continue
+
+            brain.learn()
+            step += 1
+            if step % syncEvery == 0:
+                broadcast(brain, weights)
+            if step % targetEvery == 0:
+                brain.updateNetwork()
+            if step % 1000 == 0:
+                print("Learn step: ", step, "\tEpisodes: ", len(scores), "\tAverage Score: ", np.mean(scores[-100:]) if scores else 0, "\tMemory: ", brain.memory.len)
+                if quantized and not floatOnly.is_set():
+                    agreement = quantizedAgreement(brain)
+                    print("Quantized actors agree with the float network on", agreement, "of greedy actions")
+                    if agreement < minAgreement:
+                        print("That is below", minAgreement, "so the actors go back to the float network")
+                        floatOnly.set()
+    finally:
+        stop.set()
+        for process in actors:
+            process.join(timeout=5)
+
+    brain.save(path)
+    return brain, scores
+
+def cpuWeights(brain):
+    return {name: tensor.cpu() for name, tensor in brain.DQN.state_dict().items()}
+
+def quantizedAgreement(brain, n=2048):
+    with brain.memoryLock:
+        states = brain.memory.sample(min(n, brain.memory.len))[0]
+    return greedyAgreement(brain.DQN, quantizedPolicy(brain.DQN), states)
+
+# Replace whatever weights an actor has not picked up yet with the latest ones
+def broadcast(brain, weights):
+    state = cpuWeights(brain)
+    for q in weights:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put(state)
+
+if __name__ == '__main__':
+    learner(*[int(arg) for arg in sys.argv[1:3]])
@@ -1,8 +1,11 @@
 import sys
-from math import copysign, degrees, radians, sin
+from math import copysign, cos, degrees, radians, sin
+import numpy as np
 import pygame
 from pygame.math import Vector2
-from Raycast import Boundary, RayParticle
+from Profiler import profiler
+from Raycast import Boundary, BoundaryArray, RayParticle, SensorTable, WallGrid, boxHitsSegments, boxTimeOfImpact, castRays, segmentCrosses, segmentsIntersect
+from Tracks import CompiledTrack
 
 # Add done if long time no reward
 
@@ -10,64 +13,169 @@ from Raycast import Boundary, RayParticle
 MAP = [[[20, 20], [120, 20], [180, 20], [240, 20], [300, 20], [400, 20], [700, 20], [850, 20], [950, 100], [950, 700], [900, 750], [100, 750], [20, 700], [20, 20]],
        [[90, 70], [120, 70], [180, 70], [240, 70], [300, 70], [400, 70], [700, 70], [800, 70], [870, 130], [870, 670], [830, 700], [150, 700], [100, 650], [90, 70]]]
 
+# A random closed track in the same layout as MAP with nWalls walls in total, a wobbly ring around the screen
+def proceduralMap(nWalls, seed=0, center=(483, 384), radius=(400, 300), width=70, wobble=25):
+    rng = np.random.default_rng(seed)
+    theta = np.linspace(0, 2 * np.pi, max(nWalls // 2, 3) + 1)
+    offset = np.zeros_like(theta)
+    for k in range(1, 6):
+        offset += rng.uniform(-1, 1) * wobble / k * np.sin(k * theta + rng.uniform(0, 2 * np.pi))
+
+    map = []
+    for w in (0, width):
+        x = center[0] + (radius[0] + offset - w) * np.cos(theta)
+        y = center[1] + (radius[1] + offset - w) * np.sin(theta)
+        points = np.round(np.stack([x, y], axis=-1), 3).tolist()
+        points[-1] = points[0]
+        map.append(points)
+    return map
+
+# A track file is compiled (or found in the cache) on the way in, and lists of points are left as they are
+def loadTrack(maps):
+    return CompiledTrack(maps) if isinstance(maps, str) else maps
+
+# Collision models of Game: pixel perfect sprite masks, the car's footprint box at the end of each step ('box', or
+# 'geometric') or the footprint box swept along each step
+COLLISIONS = ('mask', 'box', 'swept')
+
 # Environment class: For all your training needs
 class Game:
-    def __init__(self, maps=MAP):
-        # pygame initialisations
-        pygame.init()
-        pygame.key.set_repeat(20, 20)
+    def __init__(self, maps=MAP, vectorized=True, headless=False, collision='mask', gridCell=None, sensorTable=None, frameSkip=1):
+        collision = 'box' if collision == 'geometric' else collision
+        if collision not in COLLISIONS:
+            raise ValueError("Unknown collision model {!r}, use one of 'mask', 'box' (or 'geometric') and 'swept'".format(collision))
+
+        # pygame initialisations, a headless game never opens a window or touches a display surface
+        self.headless = headless
+        if not self.headless:
+            pygame.init()
+            pygame.key.set_repeat(20, 20)
 
         self.done = False
         self.state = None
         self.reward = 0
         self.nActions = 13
         self.nInputs = 8
+        self.vectorized = vectorized
+        self.collision = collision
+        self.frameSkip = frameSkip
+        # With swept collisions, the fraction of the last physics step at which the car hit a wall
+        self.impact = None
 
         # The screen, if you decide to render the environment
         self.width = 966
         self.height = 768
-        self.screen = pygame.display.set_mode([self.width, self.height])
-        self.screen.fill([0, 0, 0])
+        self.screen = None
+        if not self.headless:
+            self.screen = pygame.display.set_mode([self.width, self.height])
+            self.screen.fill([0, 0, 0])
 
         # Objects: Car, Tracks, and Reward Gates
-        self.car = Car([100, 50], "car.png", 0)
+        # maps can also be a track file or a CompiledTrack, whose walls are not even drawn when nothing needs the
+        # masks or Boundary objects: no mask collisions, no window and the vectorized raycaster
+        # The sprite is only needed for mask collisions or for rendering
+        track = loadTrack(maps)
+        compiled = isinstance(track, CompiledTrack)
+        if compiled:
+            maps = track.maps
+        masked = self.collision == 'mask'
+        start, angle = (track.startPos, track.startAngle) if compiled else ([100, 50], 0)
+        self.car = Car(start, "car.png" if masked or not self.headless else None, angle, masked)
         self.walls = []
         self.tracks = []
-        self.gates = RewardGates(maps, self.height, self.width)
-        for map in maps:
-            self.tracks.append(Track(map[1:], map[0], self.height, self.width, self.walls))
+        self.gates = RewardGates(maps)
+        if not compiled or masked or not self.headless or not self.vectorized:
+            for map in maps:
+                self.tracks.append(Track(map[1:], map[0], self.height, self.width, self.walls))
+
+        # Wall endpoints packed once for the vectorized raycaster, with a uniform grid on top for big tracks
+        if compiled:
+            self.wallArray = BoundaryArray(self.walls, track.wallA, track.wallB) if gridCell is None else track.grid(gridCell)
+        elif gridCell is None:
+            self.wallArray = BoundaryArray(self.walls)
+        else:
+            self.wallArray = WallGrid(self.walls, gridCell)
+        self.sensors = self.wallArray if self.vectorized else self.walls
+
+        # Or look the distances up in a precomputed table, sensorTable being True or the SensorTable options
+        if sensorTable:
+            self.sensors = SensorTable(self.wallArray.a, self.wallArray.b, **(sensorTable if isinstance(sensorTable, dict) else {}))
         
     # Update at each time delta (and not frame)
-    def step(self, action, dt=0.015):
-        # Need to have this code for pygame to work
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                print("No messing with the environment or all your weights will be re-initialised to -420 ಠ_ಠ")
-
-        # Update
-        self.car.update(dt, action)
-        self.screen.fill([0, 0, 0])
-        
+    # The action is repeated for frameSkip physics steps of dt, summing the rewards and stopping early on a crash or finish
+    def step(self, action, dt=0.015, frameSkip=None):
+        with profiler.phase("Game.step"):
+            # Need to have this code for pygame to work
+            if not self.headless:
+                with profiler.phase("Game.step/events"):
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            print("No messing with the environment or all your weights will be re-initialised to -420 ಠ_ಠ")
 
-        # Determine the state of the environment
-        self.state = self.car.rayCaster.see(self.screen, self.walls, render=False)
+            self.reward = 0
+            for _ in range(self.frameSkip if frameSkip is None else frameSkip):
+                # Update
+                self.car.update(dt, action)
 
-        # Check for collisions and give rewards
-        self.reward = 0
-        if pygame.sprite.collide_mask(self.tracks[0], self.car) is not None or pygame.sprite.collide_mask(self.tracks[1], self.car) is not None:
-            self.done = True
-            self.reward = -50
-        collided, done = self.gates.collide(self.car)
-        if collided:
-            self.reward = 50
-            if done:
-                self.reward += 100
-                self.done = True
+                # Check for collisions and give rewards
+                # A swept crash puts the car back where it hit, so it only gets the gates it passed before
+                reward = 0
+                with profiler.phase("Game.step/collision"):
+                    crashed = self.crashed()
+                if crashed:
+                    self.done = True
+                    reward = -50
+                    profiler.count("Game.crashes")
+                    if self.impact is not None:
+                        self.car.rewind(self.impact)
+
+                # A long step can go through more than one gate
+                passed = 0
+                collided, done = self.gates.collide(self.car)
+                while collided:
+                    passed += 1
+                    if done:
+                        break
+                    collided, done = self.gates.collide(self.car)
+                if passed:
+                    reward = 50 * passed
+                    if done:
+                        reward += 100
+                        self.done = True
+                        profiler.count("Game.finishes")
+                self.reward += reward
+                if self.done:
+                    break
+
+            if not self.headless:
+                self.screen.fill([0, 0, 0])
+
+            # Determine the state of the environment, only once the action is through
+            with profiler.phase("Game.step/sensing"):
+                self.state = self.car.rayCaster.see(self.screen, self.sensors, render=False)
 
         return self.state, self.reward, self.done
     
-    # To render or not to render
+    # Track collision, either pixel perfect with the sprite masks or with the car's footprint box against the walls
+    # at the end of the step, or 'swept' along the whole step, also finding the time of impact
+    def crashed(self):
+        if self.collision == 'mask':
+            return pygame.sprite.collide_mask(self.tracks[0], self.car) is not None or pygame.sprite.collide_mask(self.tracks[1], self.car) is not None
+        if self.collision == 'swept':
+            start = self.car.corners(self.car.lastPos, self.car.lastAngle)
+            end = self.car.corners()
+            both = np.concatenate([start, end])
+            near = self.wallArray.near(both.min(axis=0), both.max(axis=0))
+            self.impact = boxTimeOfImpact(start, end, self.wallArray.a[near], self.wallArray.b[near]) if near.any() else None
+            return self.impact is not None
+        corners = self.car.corners()
+        near = self.wallArray.near(corners.min(axis=0), corners.max(axis=0))
+        return bool(near.any() and boxHitsSegments(corners, self.wallArray.a[near], self.wallArray.b[near]).any())
+
+    # To render or not to render, there is nothing to render to when headless
     def render(self):
+        if self.headless:
+            return
         for track in self.tracks:
             track.display(self.screen)
         self.car.display(self.screen)
@@ -76,106 +184,285 @@ class Game:
     
     # Resetting the environment so that the fun never stops
     def reset(self):
+        profiler.count("Game.resets")
         self.done = False
         self.car.reset()
         self.gates.reset()
-        self.state = self.car.rayCaster.see(self.screen, self.walls, render=False)
+        self.state = self.car.rayCaster.see(self.screen, self.sensors, render=False)
         return self.state
     
     def close(self):
         sys.exit()
 
+# Corners of the footprint box of cars at pos [..., 2] facing angle [...] in degrees, shape [..., 4, 2]
+def carCorners(pos, angle):
+    heading = np.radians(angle)
+    front = np.stack([np.cos(heading), -np.sin(heading)], axis=-1) * (Car.size[0] / 2)
+    side = np.stack([np.sin(heading), np.cos(heading)], axis=-1) * (Car.size[1] / 2)
+    return np.stack([front + side, front - side, -front - side, -front + side], axis=-2) + pos[..., None, :]
+
+# The same game for N cars at once: physics, sensing, collisions and rewards all done on arrays
+# Cars that crash, finish or run out of maxSteps are reset on their own: step returns the observations they ended
+# on, and state holds the fresh ones to act on next. Running out of steps is reported apart from crashes and
+# finishes, it is not a terminal state to learn from
+# The start pose and the first gate to reach can be the same for all cars or given per car
+class VecGame:
+    def __init__(self, nCars, maps=MAP, maxSteps=None, startPos=None, startAngle=None, sensorTable=None, startGate=1):
+        self.nCars = nCars
+        self.nActions = 13
+        self.nInputs = 8
+        self.maxSteps = maxSteps
+
+        # Walls go from each point of a map to the next, gates across matching points of both maps
+        # A compiled track has them all ready, along with its start pose
+        track = loadTrack(maps)
+        if isinstance(track, CompiledTrack):
+            self.wallA, self.wallB, self.gateA, self.gateB = track.wallA, track.wallB, track.gateA, track.gateB
+            startPos = track.startPos if startPos is None else startPos
+            startAngle = track.startAngle if startAngle is None else startAngle
+        else:
+            self.wallA = np.array([p for map in maps for p in map[:-1]], dtype=np.float64)
+            self.wallB = np.array([p for map in maps for p in map[1:]], dtype=np.float64)
+            self.gateA = np.array(maps[0], dtype=np.float64)
+            self.gateB = np.array(maps[1], dtype=np.float64)
+        self.nGates = min(len(self.gateA), len(self.gateB))
+        self.table = None
+        if sensorTable:
+            self.table = SensorTable(self.wallA, self.wallB, **(sensorTable if isinstance(sensorTable, dict) else {}))
+
+        self.startPos = np.broadcast_to(np.array((100, 50) if startPos is None else startPos, dtype=np.float64), (nCars, 2)).copy()
+        self.startAngle = np.broadcast_to(np.array(0.0 if startAngle is None else startAngle, dtype=np.float64), (nCars,)).copy()
+        self.startGate = np.broadcast_to(np.array(startGate, dtype=np.int64), (nCars,)).copy()
+        self.rayAngles = np.arange(0, 360, 360 // self.nInputs, dtype=np.float64)
+
+        self.pos = np.zeros((nCars, 2))
+        self.lastPos = np.zeros((nCars, 2))
+        self.velocity = np.zeros(nCars)
+        self.angle = np.zeros(nCars)
+        self.acceleration = np.zeros(nCars)
+        self.steering = np.zeros(nCars)
+        self.gate = np.zeros(nCars, dtype=np.int64)
+        self.steps = np.zeros(nCars, dtype=np.int64)
+        self.state = np.zeros((nCars, self.nInputs))
+        self.reset()
+
+    # Reset all cars, or only the ones selected by a boolean mask
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.nCars, dtype=bool)
+        self.pos[mask] = self.startPos[mask]
+        self.lastPos[mask] = self.startPos[mask]
+        self.velocity[mask] = 0.0
+        self.angle[mask] = self.startAngle[mask]
+        self.acceleration[mask] = 0.0
+        self.steering[mask] = 0.0
+        self.gate[mask] = self.startGate[mask]
+        self.steps[mask] = 0
+        self.state[mask] = self.see(mask)
+        return self.state
+
+    # Same rules as Car.update, one row per car
+    def update(self, dt, actions):
+        v = self.velocity
+        forward = np.isin(actions, [1, 6, 7])
+        backward = np.isin(actions, [2, 8, 9])
+        brake = np.isin(actions, [5, 10, 11])
+        idle = ~(forward | backward | brake)
+
+        acc = self.acceleration
+        acc = np.where(forward, np.where(v < 0, Car.decel, Car.maxAccel), acc)
+        acc = np.where(backward, np.where(v > 0, -Car.decel, -Car.maxAccel), acc)
+        acc = np.where(brake & (v != 0), np.copysign(Car.maxAccel, -v), acc)
+        if dt != 0:
+            stop = -v / dt
+        else:
+            stop = acc
+        acc = np.where(idle, np.where(np.abs(v) > dt * Car.freeDecel, -np.copysign(Car.freeDecel, v), stop), acc)
+        self.acceleration = acc
+
+        left = np.isin(actions, [3, 6, 8])
+        right = np.isin(actions, [4, 7, 9])
+        self.steering = np.where(left, self.steering + 30 * dt, np.where(right, self.steering - 30 * dt, 0.0))
+        self.steering = np.clip(self.steering, -Car.maxSteer, Car.maxSteer)
+
+        self.velocity = np.clip(v + acc * dt, -Car.maxVelocity, Car.maxVelocity)
+
+        with np.errstate(divide='ignore'):
+            radius = Car.length / np.sin(np.radians(self.steering))
+        angularVelocity = np.where(self.steering != 0, self.velocity / radius, 0.0)
+
+        heading = np.radians(self.angle)
+        self.lastPos = self.pos.copy()
+        self.pos += np.stack([np.cos(heading), -np.sin(heading)], axis=-1) * (self.velocity * dt)[:, None]
+        self.angle = self.angle + np.degrees(angularVelocity) * dt
+
+    # The 8 ray distances of every car (or of the selected ones), shape [nCars, nInputs]
+    def see(self, index=slice(None)):
+        if self.table is not None:
+            return self.table.lookup(self.pos[index, None, :], self.rayAngles[None, :] - self.angle[index, None])
+        angles = np.radians(self.rayAngles[None, :] - self.angle[index, None])
+        directions = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+        origins = np.broadcast_to(self.pos[index, None, :], directions.shape)
+        distances, _ = castRays(origins, directions, self.wallA, self.wallB)
+        return distances
+
+    def step(self, actions, dt=0.015):
+        actions = np.asarray(actions)
+        self.update(dt, actions)
+        self.steps += 1
+        states = self.see()
+
+        # Check for collisions and give rewards, by the same rules as Game.step
+        crashed = boxHitsSegments(carCorners(self.pos, self.angle), self.wallA, self.wallB).any(axis=-1)
+        rewards = np.where(crashed, -50, 0)
+
+        gate = np.minimum(self.gate, self.nGates - 1)
+        racing = self.gate < self.nGates
+        passed = racing & segmentsIntersect(self.lastPos, self.pos, self.gateA[gate], self.gateB[gate])
+        finished = passed & (self.gate == self.nGates - 1)
+        self.gate += passed
+        rewards = np.where(passed, 50, rewards) + np.where(finished, 100, 0)
+
+        dones = crashed | finished
+        truncated = ~dones & (self.steps >= self.maxSteps) if self.maxSteps is not None else np.zeros_like(dones)
+        self.state = states.copy()
+        if (dones | truncated).any():
+            self.reset(dones | truncated)
+
+        return states, rewards, dones, truncated
+
 # *slaps roof* This bad boy can go 320 pixels/dt
 # Car class with mask collision and in-built raycasting to view the environment
 class Car(pygame.sprite.Sprite):
-    def __init__(self, pos, image, angle=0.0):
+    # Physical parameters, shared with the batched VecGame
+    length = 4
+    maxVelocity = 320
+    decel = 320
+    freeDecel = 80
+    maxAccel = 160
+    maxSteer = 4
+    # Footprint of the opaque pixels of car.png, facing angle 0
+    size = (32, 14)
+
+    # Without masked, the sprite is only rotated when displayed and image may be None when never displayed
+    def __init__(self, pos, image, angle=0.0, masked=True):
         pygame.sprite.Sprite.__init__(self)
         
-        # Physical parameters
-        self.image = pygame.image.load(image)
-        self.rotated = pygame.transform.rotate(self.image, angle)
-        self.mask = pygame.mask.from_surface(self.rotated)
+        self.masked = masked
+        self.image = pygame.image.load(image) if image is not None else None
+        self.mask = None
         self.pos = Vector2(pos[0], pos[1])
-        self.rect = self.rotated.get_rect(center=self.pos)
-        self.velocity = Vector2(0.0, 0.0)
+        self.lastPos = Vector2(pos[0], pos[1])
         self.angle = angle
+        self.lastAngle = angle
+        if self.masked:
+            self.rotate()
+        self.velocity = Vector2(0.0, 0.0)
         self.acceleration = 0.0
         self.steering = 0.0
 
         self.startPos = Vector2(pos[0], pos[1])
         self.startAngle = angle
-        self.length = 4
-        self.maxVelocity = 320
-        self.decel = 320
-        self.freeDecel = 80
-        self.maxAccel = 160
-        self.maxSteer = 4
         self.rayCaster = RayParticle(self.pos)
 
     # Move the car one time delta's worth
     def update(self, dt, action):
-        # Actions: [[0, Idle], [1, Forward], [2, Backward], [3, Left], [4, Right], [5, Brake],[6, Forward, Left],
-        # [7, Forward, Right], [8, Backward, Left], [9, Backward, Right], [10, Brake, Left], [11, Brake, Right]]
-        # Perform actions and determine variables
-        self.action = action
-        if self.action in [1, 6, 7]:        # Forward
-            if self.velocity.x < 0:
-                self.acceleration = self.decel
-            else:
-                self.acceleration = self.maxAccel
-        elif self.action in [2, 8, 9]:       # Backward
-            if self.velocity.x > 0:
-                self.acceleration = -self.decel
+        with profiler.phase("Car.update"):
+            # Actions: [[0, Idle], [1, Forward], [2, Backward], [3, Left], [4, Right], [5, Brake],[6, Forward, Left],
+            # [7, Forward, Right], [8, Backward, Left], [9, Backward, Right], [10, Brake, Left], [11, Brake, Right]]
+            # Perform actions and determine variables
+            self.action = action
+            if self.action in [1, 6, 7]:        # Forward
+                if self.velocity.x < 0:
+                    self.acceleration = self.decel
+                else:
+                    self.acceleration = self.maxAccel
+            elif self.action in [2, 8, 9]:       # Backward
+                if self.velocity.x > 0:
+                    self.acceleration = -self.decel
+                else:
+                    self.acceleration = -self.maxAccel
+            elif self.action in [5, 10, 11]:     # Brakes
+                if self.velocity.x != 0:
+                    self.acceleration = copysign(self.maxAccel, -self.velocity.x)
             else:
-                self.acceleration = -self.maxAccel
-        elif self.action in [5, 10, 11]:     # Brakes
-            if self.velocity.x != 0:
-                self.acceleration = copysign(self.maxAccel, -self.velocity.x)
-        else:
-            if abs(self.velocity.x) > dt * self.freeDecel:
-                self.acceleration = -copysign(self.freeDecel, self.velocity.x)
+                if abs(self.velocity.x) > dt * self.freeDecel:
+                    self.acceleration = -copysign(self.freeDecel, self.velocity.x)
+                else:
+                    if dt != 0:
+                        self.acceleration = -self.velocity.x / dt
+            #self.acceleration = max(-self.maxAccel, min(self.acceleration, self.maxAccel))
+
+            if self.action in [3, 6, 8]:        # Left
+                self.steering += 30 * dt
+            elif self.action in [4, 7, 9]:      # Right
+                self.steering -= 30 * dt
             else:
-                if dt != 0:
-                    self.acceleration = -self.velocity.x / dt
-        #self.acceleration = max(-self.maxAccel, min(self.acceleration, self.maxAccel))
-
-        if self.action in [3, 6, 8]:        # Left
-            self.steering += 30 * dt
-        elif self.action in [4, 7, 9]:      # Right
-            self.steering -= 30 * dt
-        else:
-            self.steering = 0
-        self.steering = max(-self.maxSteer, min(self.steering, self.maxSteer))
+                self.steering = 0
+            self.steering = max(-self.maxSteer, min(self.steering, self.maxSteer))
 
-        self.velocity += (self.acceleration * dt, 0)
-        self.velocity.x = max(-self.maxVelocity, min(self.velocity.x, self.maxVelocity))
+            self.velocity += (self.acceleration * dt, 0)
+            self.velocity.x = max(-self.maxVelocity, min(self.velocity.x, self.maxVelocity))
 
-        if self.steering:
-            radius = self.length / sin(radians(self.steering))
-            angularVelocity = self.velocity.x / radius
-        else:
-            angularVelocity = 0
+            if self.steering:
+                radius = self.length / sin(radians(self.steering))
+                angularVelocity = self.velocity.x / radius
+            else:
+                angularVelocity = 0
 
-        # Change state
-        self.pos += self.velocity.rotate(-self.angle) * dt
-        self.angle += degrees(angularVelocity) * dt
-        self.rayCaster.move(self.pos, self.angle)
+            # Change state
+            self.lastPos = Vector2(self.pos)
+            self.lastAngle = self.angle
+            self.pos += self.velocity.rotate(-self.angle) * dt
+            self.angle += degrees(angularVelocity) * dt
+            self.rayCaster.move(self.pos, self.angle)
+            if self.masked:
+                with profiler.phase("Car.update/sprite"):
+                    self.rotate()
+
+    # Rotate the sprite to the current angle, rebuilding the collision mask if one is used
+    def rotate(self):
         self.rotated = pygame.transform.rotate(self.image, self.angle)
         self.rect = self.rotated.get_rect(center=self.pos)
-        self.mask = pygame.mask.from_surface(self.rotated)
+        if self.masked:
+            self.mask = pygame.mask.from_surface(self.rotated)
+
+    # Corners of the car's footprint box, shape [4, 2], same as carCorners without the array overhead
+    # Where it is now, or at another pose
+    def corners(self, pos=None, angle=None):
+        pos = self.pos if pos is None else pos
+        heading = radians(self.angle if angle is None else angle)
+        fx = cos(heading) * self.size[0] / 2
+        fy = -sin(heading) * self.size[0] / 2
+        sx = sin(heading) * self.size[1] / 2
+        sy = cos(heading) * self.size[1] / 2
+        x = pos.x
+        y = pos.y
+        return np.array([[x + fx + sx, y + fy + sy], [x + fx - sx, y + fy - sy], [x - fx - sx, y - fy - sy], [x - fx + sx, y - fy + sy]])
     
+    # Take the car back to the given fraction of its last move
+    def rewind(self, fraction):
+        self.pos = self.lastPos + (self.pos - self.lastPos) * fraction
+        self.angle = self.lastAngle + (self.angle - self.lastAngle) * fraction
+        self.rayCaster.move(self.pos, self.angle)
+        if self.masked:
+            self.rotate()
+
     # Resetting the car to it's original attributes in case of a game over or a success
     def reset(self):
         self.pos = Vector2(self.startPos)
+        self.lastPos = Vector2(self.startPos)
         self.velocity = Vector2(0.0, 0.0)
         self.angle = self.startAngle
+        self.lastAngle = self.startAngle
         self.acceleration = 0.0
         self.steering = 0.0
-        self.rotated = pygame.transform.rotate(self.image, self.angle)
-        self.rect = self.rotated.get_rect(center=self.pos)
-        self.mask = pygame.mask.from_surface(self.rotated)
+        if self.masked:
+            self.rotate()
 
     def display(self, surface):
+        if not self.masked:
+            self.rotate()
         surface.blit(self.rotated, self.pos - (self.rect.width / 2, self.rect.height / 2))
 
 # You. Shall not. Pass. The white line of negative rewards.
@@ -200,53 +487,89 @@ class Track(pygame.sprite.Sprite):
         screen.blit(self.surface, [0, 0])
 
 # Giving rewards based on checkpoints
-class RewardGates(pygame.sprite.Sprite):
-    def __init__(self, map, height, width):
-        pygame.sprite.Sprite.__init__(self)
-
-        self.height = height
-        self.width = width
+class RewardGates:
+    def __init__(self, map):
         self.map = list(zip(map[0], map[1]))
-        self.surface = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
-        self.rect = self.surface.get_rect(center=(self.width/2, self.height/2))
-        self.gates = self.map[:]
-        self.finish = self.gates.pop(0)
-        if len(self.gates) > 0:    
-            self.gate = Boundary(Vector2(self.gates[0][0]), Vector2(self.gates[0][1]), self.surface)
-            self.gates.pop(0)
-        self.mask = pygame.mask.from_surface(self.surface)
+        self.finish = self.map[0]
+        self.reset()
     
-    # If Collision happens with current gate, destroy and load next one
+    # The gate is passed when the car's motion this time delta crosses it, then the next one is loaded
     def collide(self, car):
-        if pygame.sprite.collide_mask(self, car):
-            self.surface.fill([0, 0, 0, 0])
-            l = len(self.gates)
-            if l > 0:    
-                self.gate = Boundary(Vector2(self.gates[0][0]), Vector2(self.gates[0][1]), self.surface)
-                self.gates.pop(0)
-            self.mask = pygame.mask.from_surface(self.surface)
-            
-            if l > 0:
-                return True, False
-            else:
-                return True, True
+        if self.index >= len(self.map):
+            return False, False
+        a, b = self.map[self.index]
+        with profiler.phase("RewardGates.collide"):
+            passed = segmentCrosses(car.lastPos, car.pos, a, b)
+        if passed:
+            profiler.count("RewardGates.passed")
+            self.index += 1
+            return True, self.index == len(self.map)
         return False, False
 
     # Even gates need some love and resetting from time to time
     def reset(self):
-        self.gates = self.map[:]
-        self.finish = self.gates.pop(0)
-        self.surface.fill([0, 0, 0, 0])
-        if len(self.gates) > 0:    
-            self.gate = Boundary(Vector2(self.gates[0][0]), Vector2(self.gates[0][1]), self.surface)
-            self.gates.pop(0)
-        self.mask = pygame.mask.from_surface(self.surface)
+        self.index = 1
 
     def display(self, screen):
-        screen.blit(self.surface, [0, 0])
+        if self.index < len(self.map):
+            pygame.draw.line(screen, [255, 255, 255], *self.map[self.index])
+
+# Drive randomly with mask collisions until the car crashes, episodes times, and check the footprint box on those
+# crashes: how often it hits a wall at the crash pose too, and how many steps before the masks it first does (None
+# when it never does). The box tends to be a step or two early: car.png has rounded corners and masks only overlap
+# on whole pixels
+def compareCollisions(episodes=100, seed=0, maxSteps=3000):
+    game = Game(headless=True)
+    rng = np.random.default_rng(seed)
+    atCrash = []
+    stepsEarly = []
+    for _ in range(episodes):
+        game.reset()
+        poses = []
+        for _ in range(maxSteps):
+            game.step(rng.choice([0, 1, 1, 1, 3, 4, 6, 7]))
+            poses.append([game.car.pos.x, game.car.pos.y, game.car.angle])
+            if game.done:
+                break
+        if not game.crashed():
+            continue
+
+        poses = np.array(poses)
+        hits = boxHitsSegments(carCorners(poses[:, :2], poses[:, 2]), game.wallArray.a, game.wallArray.b).any(axis=-1)
+        atCrash.append(bool(hits[-1]))
+        stepsEarly.append(len(hits) - 1 - int(hits.argmax()) if hits.any() else None)
+    return {'crashes': len(atCrash), 'atCrash': float(np.mean(atCrash)) if atCrash else None, 'stepsEarly': stepsEarly}
+
+# Drive randomly for steps steps and compare the distances from a sensor table (True or the SensorTable options) with
+# casting every ray against every wall: the median and 99th percentile errors in pixels, the share of rays off by more
+# than 10% and the share of steps with a ray off by more than 50 pixels
+def compareSensors(steps=3000, seed=0, sensorTable=True):
+    game = Game(headless=True, collision='box', sensorTable=sensorTable)
+    rng = np.random.default_rng(seed)
+    table = []
+    exact = []
+    game.reset()
+    for _ in range(steps):
+        state, _, done = game.step(rng.choice([0, 1, 1, 1, 3, 4, 6, 7]))
+        table.append(state)
+        exact.append(game.car.rayCaster.seeVectorized(None, game.wallArray, False))
+        if done:
+            game.reset()
+
+    table = np.array(table)
+    exact = np.array(exact)
+    errors = np.abs(table - exact)
+    return {'median': float(np.median(errors)), 'p99': float(np.percentile(errors, 99)),
+            'raysOff10Percent': float(np.mean(errors > 0.1 * exact)), 'stepsOff50': float(np.mean((errors > 50).any(axis=1)))}
 
 # Testing -----------------------------------------------------------------------------------------------------
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:] == ["check"]:
+    print("Sensor table against casting every wall:", compareSensors())
+    result = compareCollisions()
+    early = [k for k in result['stepsEarly'] if k is not None]
+    print("Crashes:", result['crashes'], "\tBox hits at the crash:", result['atCrash'], "\tBox first hits, steps early:", np.bincount(early).tolist())
+
+elif __name__ == "__main__":
     clock = pygame.time.Clock()
     game = Game()
     while not game.done:
@@ -0,0 +1,114 @@
+import argparse
+import json
+import time
+import numpy as np
+import torch as T
+from Environment import MAP, VecGame, loadTrack, proceduralMap
+from Tracks import CompiledTrack
+from Agent import Agent, DQN
+
+# Greedy evaluation: the policy drives one car from each of many start poses on each of many tracks, all at once,
+# with a single forward pass per decision for every car still running. Each car drives until it crashes, finishes
+# or runs out of steps, and the report says how many finished, how many gates they got through and how fast
+# Crashes are the cars' footprint box against the walls, as Train.train has them by default (not the sprite masks)
+
+# Middle of every gate (but the last) facing the middle of the next one, which is the first gate to reach from there
+# Each pose is repeated repeats times, moved by up to jitter = (pixels, degrees) at random
+def startPoses(gateA, gateB, every=1, repeats=1, jitter=(0, 0), seed=0):
+    middle = (np.asarray(gateA, dtype=np.float64) + np.asarray(gateB, dtype=np.float64)) / 2
+    gates = np.arange(0, len(middle) - 1, every)
+    ahead = middle[gates + 1] - middle[gates]
+    angle = np.degrees(np.arctan2(-ahead[:, 1], ahead[:, 0]))
+
+    rng = np.random.default_rng(seed)
+    pos = np.repeat(middle[gates], repeats, axis=0)
+    angle = np.repeat(angle, repeats)
+    pos += rng.uniform(-1, 1, pos.shape) * jitter[0]
+    angle += rng.uniform(-1, 1, angle.shape) * jitter[1]
+    return pos, angle, np.repeat(gates + 1, repeats)
+
+def gatesOf(track):
+    track = loadTrack(track)
+    if isinstance(track, CompiledTrack):
+        return track.gateA, track.gateB
+    return track[0], track[1]
+
+# policy is an Agent (acting with its policy network) or a DQN, tracks are maps, track files or CompiledTracks
+# maxSteps counts physics steps of dt, and each decision is held for frameSkip of them
+# With patience, cars that go that many steps without reaching a gate are stopped there, say ones standing still
+def evaluate(policy, tracks=(MAP,), every=1, repeats=1, jitter=(0, 0), maxSteps=1500, dt=0.015, frameSkip=1, seed=0, sensorTable=None,
+             patience=None):
+    if isinstance(policy, Agent):
+        net, device = policy.policy, policy.policyDevice
+    else:
+        net, device = policy, policy.device
+    began = time.perf_counter()
+
+    games = []
+    for track in tracks:
+        pos, angle, gate = startPoses(*gatesOf(track), every, repeats, jitter, seed)
+        games.append(VecGame(len(pos), track, startPos=pos, startAngle=angle, startGate=gate, sensorTable=sensorTable))
+    ends = np.cumsum([game.nCars for game in games])
+    slices = [slice(end - game.nCars, end) for game, end in zip(games, ends)]
+
+    nCars = ends[-1]
+    running = np.ones(nCars, dtype=bool)
+    finished = np.zeros(nCars, dtype=bool)
+    gates = np.zeros(nCars, dtype=np.int64)
+    steps = np.zeros(nCars, dtype=np.int64)
+    progress = np.zeros(nCars, dtype=np.int64)
+    toGo = np.concatenate([game.nGates - game.startGate for game in games])
+
+    tick = 0
+    while running.any() and tick < maxSteps:
+        states = np.concatenate([game.state for game in games]).astype(np.float32)
+        with T.inference_mode():
+            actions = net(T.from_numpy(states).to(device)).argmax(dim=1).cpu().numpy()
+
+        for _ in range(min(frameSkip, maxSteps - tick)):
+            tick += 1
+            for game, part in zip(games, slices):
+                live = running[part]
+                if not live.any():
+                    continue
+                # Cars that are done get reset by step, so their gate is counted from before it
+                gate = game.gate.copy()
+                _, rewards, dones, _ = game.step(actions[part], dt)
+                gates[part] = np.where(live, gate + (rewards >= 50) - game.startGate, gates[part])
+                finished[part] |= live & (rewards >= 150)
+                steps[part] = np.where(live, tick, steps[part])
+                progress[part] = np.where(live & (rewards >= 50), tick, progress[part])
+                running[part] &= ~dones
+            if patience is not None:
+                running &= tick - progress < patience
+
+    result = summary(finished, gates, toGo, steps)
+    result['tracks'] = [summary(finished[part], gates[part], toGo[part], steps[part]) for part in slices]
+    result['steps'] = tick
+    result['time'] = time.perf_counter() - began
+    return result
+
+def summary(finished, gates, toGo, steps):
+    return {'cars': len(finished), 'completionRate': float(finished.mean()), 'gatesReached': float(gates.mean()),
+            'gateFraction': float((gates / np.maximum(toGo, 1)).mean()),
+            'stepsToFinish': float(steps[finished].mean()) if finished.any() else None}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Greedy evaluation of a saved model from many start poses and tracks at once")
+    parser.add_argument("model", nargs="?", default="./car_model.pt")
+    parser.add_argument("--tracks", nargs="+", help="track files, the MAP track by default")
+    parser.add_argument("--procedural", type=int, default=0, help="also this many procedural tracks")
+    parser.add_argument("--repeats", type=int, default=4, help="cars per start pose")
+    parser.add_argument("--jitter", type=float, nargs=2, default=[5, 10], help="pixels and degrees to move start poses by")
+    parser.add_argument("--steps", type=int, default=1500)
+    parser.add_argument("--frame-skip", type=int, default=1)
+    parser.add_argument("--patience", type=int, help="stop cars that reach no gate for this many steps")
+    parser.add_argument("--actions", type=int, default=5)
+    args = parser.parse_args()
+
+    net = DQN(0, 8, 512, 512, args.actions)
+    net.load_state_dict(T.load(args.model, map_location=net.device))
+    tracks = args.tracks or [MAP]
+    tracks = tracks + [proceduralMap(60, seed=k) for k in range(args.procedural)]
+    print(json.dumps(evaluate(net, tracks, repeats=args.repeats, jitter=args.jitter, maxSteps=args.steps, frameSkip=args.frame_skip,
+                              patience=args.patience), indent=2))
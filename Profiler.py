@@ -0,0 +1,71 @@
+import time
+
+# Named phase timers and counters for the hot paths, off by default so instrumented code only pays for a call
+# Use the process wide profiler: with profiler.phase("Game.step/sensing"): ... and profiler.count("crashes")
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    # Turning it on starts measuring afresh, so the first report only covers the time since
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if enabled:
+            self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return NO_PHASE
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Everything measured since the last reset, times in seconds
+    def stats(self):
+        return {"seconds": time.perf_counter() - self.started,
+                "phases": {name: {"calls": self.calls[name], "total": self.times[name], "mean": self.times[name] / self.calls[name]} for name in self.times},
+                "counters": dict(self.counters)}
+
+    # A table of the phases, slowest in total first, and the counters
+    def report(self):
+        stats = self.stats()
+        lines = ["{:<32} {:>10} {:>10} {:>12} {:>7}".format("phase", "calls", "total s", "mean us", "share")]
+        for name, phase in sorted(stats["phases"].items(), key=lambda item: -item[1]["total"]):
+            lines.append("{:<32} {:>10} {:>10.3f} {:>12.1f} {:>6.1%}".format(name, phase["calls"], phase["total"], phase["mean"] * 1e6, phase["total"] / stats["seconds"]))
+        for name, value in sorted(stats["counters"].items()):
+            lines.append("{:<32} {:>10}".format(name, value))
+        return "\n".join(lines)
+
+class Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+# Shared stand in for a phase while profiling is off
+class NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+NO_PHASE = NoPhase()
+profiler = Profiler()
@@ -1,7 +1,10 @@
+import hashlib
+import os
 import pygame
 from pygame import Vector2
+import numpy as np
 import sys
-from math import cos, sin, radians
+from math import cos, floor, inf, sin, radians
 from random import randint
 
 
@@ -16,6 +19,324 @@ class Boundary(pygame.sprite.Sprite):
         pygame.draw.line(self.surface, color, self.a, self.b)
 
 
+# All the walls of a track packed into contiguous endpoint arrays, built once and cast against in bulk
+# The endpoint arrays a and b can also be given ready made, say from a compiled track, with no Boundary behind them
+class BoundaryArray:
+    def __init__(self, walls, a=None, b=None):
+        self.walls = walls
+        if a is None:
+            a = np.array([[wall.a.x, wall.a.y] for wall in walls], dtype=np.float64).reshape(-1, 2)
+            b = np.array([[wall.b.x, wall.b.y] for wall in walls], dtype=np.float64).reshape(-1, 2)
+        self.a = a
+        self.b = b
+        self.lo = np.minimum(self.a, self.b)
+        self.hi = np.maximum(self.a, self.b)
+
+    def __len__(self):
+        return len(self.a)
+
+    # Which walls have a bounding box overlapping the box from lo to hi, for cheaply skipping far away walls
+    def near(self, lo, hi):
+        return ((self.lo <= hi) & (self.hi >= lo)).all(axis=1)
+
+
+# A uniform grid over the walls so a ray only tests the walls in the cells it passes through
+# Walls are bucketed into every cell their bounding box overlaps, unless the buckets come ready made as the
+# flat arrays of packCells
+class WallGrid(BoundaryArray):
+    def __init__(self, walls, cellSize=32, a=None, b=None, cells=None):
+        BoundaryArray.__init__(self, walls, a, b)
+        self.cellSize = cellSize
+        self.origin = self.lo.min(axis=0) if len(self) else np.zeros(2)
+        top = self.hi.max(axis=0) if len(self) else np.zeros(2)
+        self.nx, self.ny = (np.floor((top - self.origin) / cellSize).astype(int) + 1).tolist()
+
+        if cells is not None:
+            starts, ids = cells
+            self.cells = [ids[start:end] if end > start else None for start, end in zip(starts[:-1].tolist(), starts[1:].tolist())]
+            return
+        buckets = [[] for _ in range(self.nx * self.ny)]
+        first = np.floor((self.lo - self.origin) / cellSize).astype(int)
+        last = np.floor((self.hi - self.origin) / cellSize).astype(int)
+        for wall, (i0, j0), (i1, j1) in zip(range(len(self)), first, last):
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    buckets[i * self.ny + j].append(wall)
+        self.cells = [np.array(bucket, dtype=np.int64) if bucket else None for bucket in buckets]
+
+    # The buckets as flat arrays: the walls of cell k are ids[starts[k]:starts[k + 1]]
+    def packCells(self):
+        counts = [len(cell) if cell is not None else 0 for cell in self.cells]
+        starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        ids = np.concatenate([cell for cell in self.cells if cell is not None] or [np.zeros(0, dtype=np.int64)])
+        return starts, ids
+
+    # Walk the cells along one ray (Amanatides & Woo), yielding each cell and how far along the ray it is left
+    def walk(self, origin, direction):
+        x, y = origin
+        dx, dy = direction
+        cs = self.cellSize
+        x0, y0 = self.origin
+        x1 = x0 + self.nx * cs
+        y1 = y0 + self.ny * cs
+
+        # Clip the ray to the grid
+        tEnter = 0.0
+        tExit = inf
+        for p, d, lo, hi in ((x, dx, x0, x1), (y, dy, y0, y1)):
+            if d == 0:
+                if not lo <= p < hi:
+                    return
+            else:
+                tLo = (lo - p) / d
+                tHi = (hi - p) / d
+                tEnter = max(tEnter, min(tLo, tHi))
+                tExit = min(tExit, max(tLo, tHi))
+        if tEnter > tExit:
+            return
+
+        i = min(max(floor((x + tEnter * dx - x0) / cs), 0), self.nx - 1)
+        j = min(max(floor((y + tEnter * dy - y0) / cs), 0), self.ny - 1)
+        stepI = 1 if dx > 0 else -1
+        stepJ = 1 if dy > 0 else -1
+        tMaxX = (x0 + (i + (dx > 0)) * cs - x) / dx if dx != 0 else inf
+        tMaxY = (y0 + (j + (dy > 0)) * cs - y) / dy if dy != 0 else inf
+        tDeltaX = cs / abs(dx) if dx != 0 else inf
+        tDeltaY = cs / abs(dy) if dy != 0 else inf
+
+        while 0 <= i < self.nx and 0 <= j < self.ny:
+            yield i * self.ny + j, min(tMaxX, tMaxY)
+            if tMaxX < tMaxY:
+                i += stepI
+                tMaxX += tDeltaX
+            else:
+                j += stepJ
+                tMaxY += tDeltaY
+
+    # Same as castRays for rays [n, 2], but each ray only tests the walls up to the first cell holding its hit
+    # All rays are walked to their next non empty cell and the new walls are tested together, until every ray is done
+    def cast(self, origins, directions, far=1000000000):
+        distances = np.full(len(origins), far, dtype=np.float64)
+        points = np.zeros((len(origins), 2))
+        walkers = [self.walk(o, d) for o, d in zip(origins.tolist(), directions.tolist())]
+        active = list(range(len(walkers)))
+        while active:
+            walking = []
+            exits = []
+            wallIds = []
+            for k in active:
+                for cell, tExit in walkers[k]:
+                    if self.cells[cell] is not None:
+                        walking.append(k)
+                        exits.append(tExit)
+                        wallIds.append(self.cells[cell])
+                        break
+            if not walking:
+                break
+
+            # One (ray, wall) pair per wall in the cell each ray just reached
+            counts = [len(ids) for ids in wallIds]
+            rayIds = np.repeat(walking, counts)
+            wallIds = np.concatenate(wallIds)
+            u, t = rayHits(origins[rayIds], directions[rayIds], self.a[wallIds], self.b[wallIds], far)
+
+            # Walls of earlier cells were already tested, so a best hit before this cell's exit is the nearest one
+            active = []
+            start = 0
+            for k, tExit, count in zip(walking, exits, counts):
+                nearest = start + u[start:start + count].argmin()
+                if u[nearest] < distances[k]:
+                    distances[k] = u[nearest]
+                    points[k] = self.a[wallIds[nearest]] + t[nearest] * (self.b[wallIds[nearest]] - self.a[wallIds[nearest]])
+                if distances[k] > tExit:
+                    active.append(k)
+                start += count
+
+        return distances, points
+
+
+# Bump when the way tables are built changes, so old cached tables are not picked up
+SENSOR_VERSION = 2
+
+# Ray distances precomputed for the static walls a-b over a grid of positions and absolute ray directions, answered by
+# interpolating in the table instead of casting rays. cellSize (pixels) and angleStep (degrees) trade accuracy for
+# size, building a table bigger than maxBytes is refused. Tables are cached in cache as .npy files keyed by a hash
+# of the walls and the resolution, and memory mapped when loaded
+# Long rays change a lot from one angle to the next, so angles are finer than positions by default: at 5 degrees,
+# blending across depth jumps leaves 5% of rays off by more than 10% (Environment.compareSensors checks a table)
+class SensorTable:
+    def __init__(self, a, b, cellSize=4, angleStep=1, cache='./sensor_cache', maxBytes=256 * 2 ** 20, far=1000000000):
+        self.cellSize = cellSize
+        self.angleStep = angleStep
+        self.far = far
+        self.origin = np.minimum(a, b).min(axis=0)
+        self.nx, self.ny = (np.ceil((np.maximum(a, b).max(axis=0) - self.origin) / cellSize).astype(int) + 1).tolist()
+        self.nAngles = int(round(360 / angleStep))
+
+        size = self.nx * self.ny * self.nAngles * 4
+        if size > maxBytes:
+            raise ValueError("A sensor table at {} px and {} degrees takes {:.0f} MB, more than the {:.0f} MB allowed".format(
+                cellSize, angleStep, size / 2 ** 20, maxBytes / 2 ** 20))
+
+        key = hashlib.sha1(np.concatenate([a, b]).astype(np.float64).tobytes() + repr((SENSOR_VERSION, cellSize, angleStep, far)).encode()).hexdigest()
+        self.path = os.path.join(cache, 'sensors-{}.npy'.format(key)) if cache is not None else None
+        if self.path is not None and os.path.exists(self.path):
+            self.table = np.load(self.path, mmap_mode='r')
+        else:
+            self.table = self.build(a, b)
+            if self.path is not None:
+                os.makedirs(cache, exist_ok=True)
+                np.save(self.path + '.tmp.npy', self.table)
+                os.replace(self.path + '.tmp.npy', self.path)
+
+    # Cast every ray of the table, a few rows of positions at a time to keep the temporaries small
+    # The lattice lines up with the corners of the walls, so rays through a corner have to count as hits
+    def build(self, a, b):
+        table = np.empty((self.nx, self.ny, self.nAngles), dtype=np.float32)
+        theta = np.radians(np.arange(self.nAngles) * self.angleStep)
+        directions = np.stack([np.cos(theta), np.sin(theta)], axis=-1)[None, None]
+        ys = self.origin[1] + np.arange(self.ny) * self.cellSize
+        rows = max(1, 2 ** 22 // (self.ny * self.nAngles * max(len(a), 1)))
+        for i in range(0, self.nx, rows):
+            xs = self.origin[0] + np.arange(i, min(i + rows, self.nx)) * self.cellSize
+            origins = np.stack(np.meshgrid(xs, ys, indexing='ij'), axis=-1)[:, :, None]
+            table[i:i + rows] = castRays(origins, directions, a, b, self.far, inclusive=True)[0]
+        return table
+
+    # Distances for rays from points [..., 2] in absolute directions [...] (degrees), interpolated between those of
+    # the 8 surrounding table entries that see a wall, and far only when none of them does
+    def lookup(self, points, directions):
+        gx = np.clip((points[..., 0] - self.origin[0]) / self.cellSize, 0, self.nx - 1)
+        gy = np.clip((points[..., 1] - self.origin[1]) / self.cellSize, 0, self.ny - 1)
+        ga = np.mod(directions, 360) / self.angleStep
+        gx, gy, ga = np.broadcast_arrays(gx, gy, ga)
+        x0 = np.minimum(gx.astype(int), self.nx - 2)
+        y0 = np.minimum(gy.astype(int), self.ny - 2)
+        a0 = ga.astype(int)
+        fx = gx - x0
+        fy = gy - y0
+        fa = ga - a0
+
+        # All 8 corners in one gather from the flattened table, x then y then angle varying fastest
+        dx = np.array([0, 0, 0, 0, 1, 1, 1, 1]).reshape((8,) + (1,) * gx.ndim)
+        dy = np.array([0, 0, 1, 1, 0, 0, 1, 1]).reshape(dx.shape)
+        da = np.array([0, 1, 0, 1, 0, 1, 0, 1]).reshape(dx.shape)
+        flat = ((x0 + dx) * self.ny + y0 + dy) * self.nAngles + (a0 + da) % self.nAngles
+        corners = self.table.reshape(-1)[flat].astype(np.float64)
+        weights = np.where(dx, fx, 1 - fx) * np.where(dy, fy, 1 - fy) * np.where(da, fa, 1 - fa)
+
+        seen = corners < self.far
+        weights = np.where(seen, weights, 0)
+        # A corner exactly on a missing entry has all the weight on it, so spread it evenly over the others
+        weights = np.where(weights.sum(axis=0) > 0, weights, seen)
+        total = weights.sum(axis=0)
+        distances = (weights * np.where(seen, corners, 0)).sum(axis=0) / np.maximum(total, 1e-12)
+        return np.where(total > 0, distances, self.far)
+
+
+# Ray x wall intersections, element by element over [..., 2] arrays, same maths as Ray.raycast
+# Returns how far along each ray the wall is hit (far if it is not) and where along the wall
+# inclusive also counts rays through the ends of a wall, which would otherwise slip between two walls sharing a corner
+def rayHits(origins, directions, a, b, far=1000000000, inclusive=False):
+    x1 = a[..., 0]
+    y1 = a[..., 1]
+    x2 = b[..., 0]
+    y2 = b[..., 1]
+
+    x3 = origins[..., 0]
+    y3 = origins[..., 1]
+    x4 = x3 + directions[..., 0]
+    y4 = y3 + directions[..., 1]
+
+    den = (x1 - x2) * (y3 - y4) - (y1 - y2) * (x3 - x4)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((x1 - x3) * (y3 - y4) - (y1 - y3) * (x3 - x4)) / den
+        u = -((x1 - x2) * (y1 - y3) - (y1 - y2) * (x1 - x3)) / den
+
+    if inclusive:
+        hit = (den != 0) & (t >= 0) & (t <= 1) & (u > 0) & (u < far)
+    else:
+        hit = (den != 0) & (t > 0) & (t < 1) & (u > 0) & (u < far)
+    return np.where(hit, u, far), np.where(hit, t, 0)
+
+
+# Cast any number of rays against every wall at once
+# origins and directions have shape [..., 2], a and b have shape [nWalls, 2]
+# Returns the distance (in ray direction lengths, 1e9 if nothing is hit) and hit point of the nearest wall per ray
+def castRays(origins, directions, a, b, far=1000000000, inclusive=False):
+    u, t = rayHits(origins[..., None, :], directions[..., None, :], a, b, far, inclusive)
+    nearest = u.argmin(axis=-1)
+    distances = np.take_along_axis(u, nearest[..., None], axis=-1)[..., 0]
+    t = np.take_along_axis(t, nearest[..., None], axis=-1)
+    points = a[nearest] + t * (b[nearest] - a[nearest])
+
+    return distances, points
+
+
+# z component of the cross product of two [..., 2] vectors
+def cross(v, w):
+    return v[..., 0] * w[..., 1] - v[..., 1] * w[..., 0]
+
+
+# Do the segments p1-p2 and a-b cross each other? Broadcasts over leading dimensions like castRays
+def segmentsIntersect(p1, p2, a, b):
+    d1 = p2 - p1
+    d2 = b - a
+    # Each segment's endpoints must lie on opposite sides of (or on) the other's line
+    straddle1 = cross(d1, a - p1) * cross(d1, b - p1) <= 0
+    straddle2 = cross(d2, p1 - a) * cross(d2, p2 - a) <= 0
+
+    return (cross(d1, d2) != 0) & straddle1 & straddle2
+
+
+# segmentsIntersect for a single pair of segments given as (x, y) pairs, without the numpy overhead
+def segmentCrosses(p1, p2, a, b):
+    d1x = p2[0] - p1[0]
+    d1y = p2[1] - p1[1]
+    d2x = b[0] - a[0]
+    d2y = b[1] - a[1]
+    if d1x * d2y - d1y * d2x == 0:
+        return False
+
+    straddle1 = (d1x * (a[1] - p1[1]) - d1y * (a[0] - p1[0])) * (d1x * (b[1] - p1[1]) - d1y * (b[0] - p1[0])) <= 0
+    straddle2 = (d2x * (p1[1] - a[1]) - d2y * (p1[0] - a[0])) * (d2x * (p2[1] - a[1]) - d2y * (p2[0] - a[0])) <= 0
+    return straddle1 and straddle2
+
+
+# Does the convex box with corners [..., 4, 2] touch any of the segments a-b? Returns [..., nSegments]
+# a and b are [nSegments, 2] shared by all boxes, or [..., 1, nSegments, 2] to give each box its own
+def boxHitsSegments(corners, a, b):
+    start = corners[..., :, None, :]
+    end = corners[..., [1, 2, 3, 0], None, :]
+    crossing = segmentsIntersect(start, end, a, b).any(axis=-2)
+
+    # A segment lying completely inside the box does not cross any of its edges
+    side = cross(end - start, a - start)
+    inside = (side >= 0).all(axis=-2) | (side <= 0).all(axis=-2)
+
+    return crossing | inside
+
+
+# Earliest fraction of the move of a box from corners start [4, 2] to corners end [4, 2] at which it touches one of
+# the segments a-b [nSegments, 2], or None if it never does. Corners move in straight lines and the segment ends are
+# moved back along the move of the box against its starting edges, which is exact for a box that does not turn
+def boxTimeOfImpact(start, end, a, b):
+    if len(a) == 0:
+        return None
+    cornerHits, _ = rayHits(start[:, None, :], (end - start)[:, None, :], a, b, 2)
+    points = np.concatenate([a, b])[:, None, :]
+    motion = start.mean(axis=0) - end.mean(axis=0)
+    endHits, _ = rayHits(points, motion, start, start[[1, 2, 3, 0]], 2)
+
+    impact = min(cornerHits.min(), endHits.min())
+    if impact <= 1:
+        return float(impact)
+    # Only touching once turned, there is no telling when
+    if boxHitsSegments(end, a, b).any():
+        return 1.0
+    return None
+
+
 class Ray:
     def __init__(self, position, direction):
         self.pos = position
@@ -74,6 +395,12 @@ class RayParticle:
         pygame.draw.circle(surface, self.color, (int(self.pos.x), int(self.pos.y)), 4)
 
     def see(self, surface, walls, render):
+        if isinstance(walls, SensorTable):
+            return self.seeTable(walls)
+        if isinstance(walls, WallGrid):
+            return self.seeGrid(surface, walls, render)
+        if isinstance(walls, BoundaryArray):
+            return self.seeVectorized(surface, walls, render)
 
         distances = []
         for ray in self.rays:
@@ -91,6 +418,40 @@ class RayParticle:
             distances.append(dmin)
         return distances
 
+    # Same as see, but every ray x wall intersection is done in a single numpy computation
+    def seeVectorized(self, surface, walls, render):
+        origins = np.array([[ray.pos.x, ray.pos.y] for ray in self.rays])
+        directions = np.array([[ray.dir.x, ray.dir.y] for ray in self.rays])
+        distances, points = castRays(origins, directions, walls.a, walls.b)
+
+        if render:
+            for d, pt in zip(distances, points):
+                if d < 1000000000:
+                    pygame.draw.circle(surface, self.color, [int(pt[0]), int(pt[1])], 4)
+                    pygame.draw.line(surface, self.color, self.pos, pt)
+        return distances
+
+    # Same as see, but each ray only tests the walls of the grid cells it passes through
+    def seeGrid(self, surface, walls, render):
+        origins = np.array([[ray.pos.x, ray.pos.y] for ray in self.rays])
+        directions = np.array([[ray.dir.x, ray.dir.y] for ray in self.rays])
+        distances, points = walls.cast(origins, directions)
+
+        if render:
+            for d, pt in zip(distances, points):
+                if d < 1000000000:
+                    pygame.draw.circle(surface, self.color, [int(pt[0]), int(pt[1])], 4)
+                    pygame.draw.line(surface, self.color, self.pos, pt)
+        return distances
+
+    # Same as see, but looking the distances up in a precomputed table, nothing is drawn
+    def seeTable(self, table):
+        directions = np.array([[ray.dir.x, ray.dir.y] for ray in self.rays])
+        lengths = np.hypot(directions[:, 0], directions[:, 1])
+        distances = table.lookup(np.array([self.pos.x, self.pos.y]), np.degrees(np.arctan2(directions[:, 1], directions[:, 0])))
+        # Distances are counted in ray direction lengths
+        return np.where(distances >= table.far, table.far, distances / lengths)
+
     def move(self, pos=None, angle=None):
         if pos == None:
             pos = self.pos
@@ -0,0 +1,145 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+import pygame
+from Environment import carCorners
+
+# Records what a Game looks like at every step into a ring buffer: the car pose, its ray distances, the gate it is
+# heading for and the reward. Recording costs a few array writes, drawing is left to the viewer below which replays
+# the saved recordings in a process of its own, at its own frame rate
+class Recorder:
+    def __init__(self, game, capacity=10000):
+        self.capacity = capacity
+        self.walls = np.stack([game.wallArray.a, game.wallArray.b], axis=1).astype(np.float32)
+        self.gates = np.array(game.gates.map, dtype=np.float32)
+        self.rayAngles = np.arange(0, 360, game.car.rayCaster.step, dtype=np.float32)
+        self.size = (game.width, game.height)
+
+        self.pos = np.zeros((capacity, 2), dtype=np.float32)
+        self.angle = np.zeros(capacity, dtype=np.float32)
+        self.distances = np.zeros((capacity, len(self.rayAngles)), dtype=np.float32)
+        self.gate = np.zeros(capacity, dtype=np.int16)
+        self.reward = np.zeros(capacity, dtype=np.float32)
+        self.episode = np.zeros(capacity, dtype=np.int32)
+        self.counter = 0
+        self.len = 0
+
+        self.queue = None
+        self.thread = None
+
+    def record(self, game, episode=0):
+        i = self.counter
+        self.pos[i] = game.car.pos.x, game.car.pos.y
+        self.angle[i] = game.car.angle
+        self.distances[i] = game.state
+        self.gate[i] = game.gates.index
+        self.reward[i] = game.reward
+        self.episode[i] = episode
+        self.counter = (i + 1) % self.capacity
+        self.len = min(self.len + 1, self.capacity)
+
+    def clear(self):
+        self.counter = 0
+        self.len = 0
+
+    # The recorded steps, oldest first
+    def frames(self):
+        order = (self.counter - self.len + np.arange(self.len)) % self.capacity
+        return {'pos': self.pos[order], 'angle': self.angle[order], 'distances': self.distances[order], 'gate': self.gate[order],
+                'reward': self.reward[order], 'episode': self.episode[order], 'walls': self.walls, 'gates': self.gates,
+                'rayAngles': self.rayAngles, 'size': np.array(self.size)}
+
+    # Write the recording to path on a background thread, replacing the old file in one go for a viewer following it
+    def save(self, path, wait=False):
+        if self.thread is None:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((path, self.frames()))
+        if wait:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            path, frames = item
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **frames)
+            os.replace(path + '.tmp', path)
+            self.queue.task_done()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+# Play a saved recording at fps frames per second, and with follow, start over on the newest one whenever it changes
+def view(path, fps=60, follow=False):
+    pygame.init()
+    clock = pygame.time.Clock()
+    screen = None
+    modified = None
+    while True:
+        if modified == os.path.getmtime(path):
+            time.sleep(0.1)
+        else:
+            modified = os.path.getmtime(path)
+            with np.load(path) as recording:
+                frames = dict(recording)
+            if screen is None:
+                screen = pygame.display.set_mode(frames['size'].tolist())
+
+            for k in range(len(frames['pos'])):
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        pygame.quit()
+                        return
+                draw(screen, frames, k)
+                pygame.display.set_caption("Episode {}  step {}  gate {}  reward {:+.0f}".format(
+                    frames['episode'][k], k, frames['gate'][k], frames['reward'][k]))
+                pygame.display.flip()
+                clock.tick(fps)
+
+        if not follow:
+            pygame.quit()
+            return
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return
+
+def draw(screen, frames, k):
+    screen.fill([0, 0, 0])
+    for a, b in frames['walls'].tolist():
+        pygame.draw.line(screen, [0, 255, 255], a, b, 2)
+    gate = frames['gate'][k]
+    if gate < len(frames['gates']):
+        pygame.draw.line(screen, [255, 255, 255], *frames['gates'][gate].tolist())
+
+    # The rays go out from the car, same directions as RayParticle.move
+    pos = frames['pos'][k]
+    angles = np.radians(frames['rayAngles'] - frames['angle'][k])
+    hits = pos + frames['distances'][k, :, None] * np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+    for d, hit in zip(frames['distances'][k], hits.tolist()):
+        if d < 1000000000:
+            pygame.draw.line(screen, [255, 255, 255], pos.tolist(), hit)
+            pygame.draw.circle(screen, [255, 255, 255], [int(hit[0]), int(hit[1])], 4)
+    pygame.draw.polygon(screen, [255, 0, 0] if frames['reward'][k] < 0 else [255, 200, 0], carCorners(pos, frames['angle'][k]).tolist())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recording saved by Recorder, say while Train.py is running")
+    parser.add_argument("path", nargs="?", default="./recording.npz")
+    parser.add_argument("--fps", type=int, default=60)
+    parser.add_argument("--follow", action="store_true", help="keep replaying the newest recording as it gets saved")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        sys.exit("No recording at " + args.path)
+    view(args.path, args.fps, args.follow)
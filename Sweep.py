@@ -0,0 +1,104 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import time
+import numpy as np
+import torch as T
+import torch.multiprocessing as mp
+from Evaluate import evaluate
+from Train import train
+
+# Hyperparameter sweeps: Train.train over a grid or a random sample of configurations, run on a pool of worker
+# processes. Every run writes its own results file to out and the runner gathers them all into out/summary.json
+
+SPACE = {'gamma': [0.95, 0.99], 'lr': [0.0005, 0.001, 0.002], 'batchSize': [32, 64], 'epsilonDecrease': [0.01, 0.02]}
+
+# Every combination of the values in space (name -> list of values), or samples random ones
+def configurations(space, samples=None, seed=0):
+    names = sorted(space)
+    if samples is None:
+        return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    rng = random.Random(seed)
+    return [{name: rng.choice(space[name]) for name in names} for _ in range(samples)]
+
+# Results file of a run, named by a hash of everything the run depends on, so a result is only reused for the same run
+def runPath(out, config, episodes, seed):
+    key = hashlib.sha1(json.dumps([config, episodes, seed], sort_keys=True).encode()).hexdigest()
+    return os.path.join(out, 'run-{}.json'.format(key[:16]))
+
+# One run in a worker process, each worker keeping to its share of the cores
+def run(index, config, episodes, out, threads, seed):
+    path = runPath(out, config, episodes, seed + index)
+    if os.path.exists(path):
+        return path
+    T.set_num_threads(threads)
+    np.random.seed(seed + index)
+    T.manual_seed(seed + index)
+
+    began = time.perf_counter()
+    brain, scores, times = train(episodes, recordEvery=0, verbose=False, **config)
+    result = {'index': index, 'config': config, 'seed': seed + index, 'scores': scores, 'episodeTimes': times,
+              'time': time.perf_counter() - began, 'averageScore': float(np.mean(scores[-100:])) if scores else None}
+    # And how the final greedy policy does from all along the track, much less noisy than the scores
+    result['evaluation'] = evaluate(brain, repeats=4, jitter=(5, 10), maxSteps=config.get('maxSteps', 1500), patience=300)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+# Gather the results files in paths, or all of them in out, best average score (over the last 100 episodes) first
+def aggregate(out, paths=None):
+    if paths is None:
+        paths = [os.path.join(out, name) for name in os.listdir(out) if name.startswith('run-') and name.endswith('.json')]
+    results = []
+    for path in paths:
+        with open(path) as f:
+            results.append(json.load(f))
+    results.sort(key=lambda r: -np.inf if r['averageScore'] is None else r['averageScore'], reverse=True)
+
+    summary = [{'index': r['index'], 'config': r['config'], 'averageScore': r['averageScore'], 'episodes': len(r['scores']),
+                'time': r['time'], 'episodeTime': float(np.mean(r['episodeTimes'])) if r['episodeTimes'] else None,
+                'completionRate': r['evaluation']['completionRate'], 'gatesReached': r['evaluation']['gatesReached']} for r in results]
+    with open(os.path.join(out, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+# Runs already in out (same configuration, episodes and seed) are not run again, so an interrupted sweep picks up
+# where it stopped. The summary only has the runs of this sweep
+def sweep(space=SPACE, episodes=50, samples=None, workers=None, threads=1, out='./sweep', seed=0):
+    os.makedirs(out, exist_ok=True)
+    workers = workers or max(1, os.cpu_count() // threads)
+    jobs = [(index, config, episodes, out, threads, seed) for index, config in enumerate(configurations(space, samples, seed))]
+
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(workers) as pool:
+        paths = pool.starmap(run, jobs, chunksize=1)
+
+    summary = aggregate(out, paths)
+    for r in summary:
+        print("{averageScore:>9.1f}  {completionRate:>6.1%}  {gatesReached:>5.1f} gates  {time:>8.1f} s  {config}".format(**r))
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train many configurations at once on a pool of processes")
+    parser.add_argument("--space", help="JSON object of parameter name to list of values, or a file holding one")
+    parser.add_argument("--episodes", type=int, default=50)
+    parser.add_argument("--samples", type=int, help="run this many random configurations instead of the whole grid")
+    parser.add_argument("--workers", type=int, help="worker processes, all the cores by default")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker")
+    parser.add_argument("--out", default="./sweep")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    space = SPACE
+    if args.space:
+        if os.path.exists(args.space):
+            with open(args.space) as f:
+                space = json.load(f)
+        else:
+            space = json.loads(args.space)
+    sweep(space, args.episodes, args.samples, args.workers, args.threads, args.out, args.seed)
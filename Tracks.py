@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import numpy as np
+from Raycast import WallGrid
+
+# Track files are JSON with the two sides of the track as lists of points, in the same layout as MAP, and the
+# start pose of the car: {"maps": [[[x, y], ...], [[x, y], ...]], "start": [x, y], "startAngle": degrees}
+# Walls join consecutive points of each side and gates join matching points of both sides
+def saveTrack(path, maps, start=(100, 50), startAngle=0.0):
+    with open(path, 'w') as f:
+        json.dump({'maps': maps, 'start': list(start), 'startAngle': startAngle}, f)
+
+# Bump when the compiled layout changes, so old artifacts are not picked up
+VERSION = 1
+
+# A track file compiled into flat arrays, saved once as .npy files under cache keyed by a hash of the file and the
+# grid cell size, and memory mapped from there every time after: no parsing, no Boundary objects, no grid bucketing
+class CompiledTrack:
+    def __init__(self, path, cache='./track_cache', gridCell=32):
+        with open(path, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha1(content + repr((VERSION, gridCell)).encode()).hexdigest()
+        self.gridCell = gridCell
+        self.path = os.path.join(cache, key)
+        if not os.path.exists(self.path):
+            self.compile(json.loads(content), cache)
+
+        arrays = {name[:-4]: np.load(os.path.join(self.path, name), mmap_mode='r') for name in os.listdir(self.path)}
+        self.wallA = arrays['wallA']
+        self.wallB = arrays['wallB']
+        self.gateA = arrays['gateA']
+        self.gateB = arrays['gateB']
+        self.cells = (arrays['cellStarts'], arrays['cellIds'])
+        self.startPos = arrays['start'][:2].tolist()
+        self.startAngle = float(arrays['start'][2])
+
+    # Both sides of the track in the MAP layout, for what still works on lists of points
+    @property
+    def maps(self):
+        return [self.gateA.tolist(), self.gateB.tolist()]
+
+    def compile(self, track, cache):
+        maps = track['maps']
+        arrays = {'wallA': np.array([p for map in maps for p in map[:-1]], dtype=np.float64),
+                  'wallB': np.array([p for map in maps for p in map[1:]], dtype=np.float64),
+                  'gateA': np.array(maps[0], dtype=np.float64),
+                  'gateB': np.array(maps[1], dtype=np.float64),
+                  'start': np.array(list(track.get('start', (100, 50))) + [track.get('startAngle', 0.0)], dtype=np.float64)}
+        grid = WallGrid([], self.gridCell, arrays['wallA'], arrays['wallB'])
+        arrays['cellStarts'], arrays['cellIds'] = grid.packCells()
+
+        # Written next to the final directory and moved in one go, whoever finishes first wins
+        os.makedirs(cache, exist_ok=True)
+        tmp = '{}.tmp{}'.format(self.path, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        try:
+            os.replace(tmp, self.path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # The walls as a WallGrid, with the compiled buckets when the cell size matches
+    def grid(self, cellSize):
+        return WallGrid([], cellSize, self.wallA, self.wallB, self.cells if cellSize == self.gridCell else None)
+
+if __name__ == '__main__':
+    # python Tracks.py tracks/*.json compiles tracks ahead of time, say before starting many workers
+    for path in sys.argv[1:]:
+        print(path, '->', CompiledTrack(path).path)
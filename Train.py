@@ -1,50 +1,101 @@
+import os
+import time
 import numpy as np
-import matplotlib.pyplot as plt
-from Environment import Game
+from Environment import MAP, Game
 from Agent import Agent
+from Evaluate import evaluate
+from Profiler import profiler
+from Recorder import Recorder
 
-env = Game()
-## Not saving 
+# One training run of episodes episodes, returning the score of every episode and how long each one took
+# recordEvery: every few episodes are recorded instead of rendered, watch them with python Recorder.py recording.npz --follow
+# profile: time the phases of the environment and learning and print them every profileEvery episodes
+# checkpointPath: checkpoint the whole training state every checkpointEvery episodes and pick up from the last one
+# evaluateEvery: print how the greedy policy does from every start pose of the track (see Evaluate.evaluate)
+# collision: the crash model, the footprint box by default like VecGame and Evaluate.evaluate, or 'mask' or 'swept'
+# updatesPerStep, targetEvery and asyncLearning go to the Agent. With targetEvery the target network follows the
+# gradient steps, otherwise it catches up every updateEvery episodes
+def train(episodes=1, gamma=0.99, epsilon=0.95, lr=0.002, batchSize=32, memSize=1000000, epsilonDecrease=0.02, nActions=5,
+          frameSkip=1, maxSteps=1500, updateEvery=10, maps=MAP, recordEvery=5, recordPath='./recording.npz',
+          profile=False, profileEvery=10, checkpointPath=None, checkpointEvery=50, evaluateEvery=0, verbose=True,
+          updatesPerStep=1.0, targetEvery=None, asyncLearning=False, collision='box'):
+    # Each decision is held for frameSkip physics steps, episodes stay maxSteps physics steps long
+    env = Game(maps, headless=True, collision=collision, frameSkip=frameSkip)
+    brain = Agent(gamma=gamma, epsilon=epsilon, lr=lr, inputs=env.nInputs, nActions=nActions, memSize=memSize, batchSize=batchSize, epsilonDecrease=epsilonDecrease,
+                  updatesPerStep=updatesPerStep, targetEvery=targetEvery, asyncLearning=asyncLearning)
+    recorder = Recorder(env, capacity=maxSteps) if recordEvery else None
+    profiler.enable(profile)
 
-nActions = env.nActions
-nInputs = env.nInputs
+    scores = []
+    times = []
+    start = 0
+    if checkpointPath is not None and os.path.exists(os.path.join(checkpointPath, 'agent.pt')):
+        progress = brain.restore(checkpointPath)
+        start = progress['episode'] + 1
+        scores = progress['scores']
+        times = progress.get('times', [])
 
-brain = Agent(gamma=0.99, epsilon=0.95, lr=0.002, inputs=nInputs, nActions=5,memSize=1000000 , batchSize=32, epsilonDecrease=0.02)
-episodes = 1
-scores = []
+    for i in range(start, episodes):
+        began = time.perf_counter()
+        done = False
+        state = env.reset()
+        score = 0
+        recording = recorder is not None and i % recordEvery == 0
+        if recording:
+            recorder.clear()
 
-for i in range(episodes):
-    done = False
-    state = env.reset()
-    score = 0
+        # The target network catches up every updateEvery episodes (4, 14, 24... by default), unless it follows the gradient steps
+        if targetEvery is None and i % updateEvery == 4 % updateEvery:
+            brain.updateNetwork()
+        j = 0
 
-    if i % 10 == 4:
-        brain.updateNetwork()
-    j = 0
+        while not done and j < maxSteps // frameSkip:
+            action = brain.choose(state)
+            newState, reward, done = env.step(action)
 
-    while not done and j < 1500:
-        action = brain.choose(state)
-        newState, reward, done = env.step(action)
+            score += reward
 
-        score += reward
+            if recording:
+                recorder.record(env, i)
+            brain.store((state, newState, reward, done, action))
+            brain.catchUp()
 
-        if i % 5 == 0:
-            env.render()
-        brain.store((state, newState, reward, done, action))
-        brain.learn()
+            state = newState
+            j += 1
 
-        state = newState
-        j += 1
+        scores.append(score)
+        times.append(time.perf_counter() - began)
+        if recording:
+            recorder.save(recordPath)
+        if verbose:
+            avgScore = np.mean(scores[-100:])
+            print("Episode: ", i, "\tScore: ", score, "\tAverage Score: ", avgScore, "\tEpsilon: ", brain.epsilon)
 
-    scores.append(score)
-    avgScore = np.mean(scores[-100:])
-    print("Episode: ", i, "\tScore: ", score, "\tAverage Score: ", avgScore, "\tEpsilon: ", brain.epsilon)
+        brain.updateEpsilon()
 
-    brain.updateEpsilon()
+        if checkpointPath is not None and i % checkpointEvery == checkpointEvery - 1:
+            brain.checkpoint(checkpointPath, {'episode': i, 'scores': scores, 'times': times})
 
-env.close()
+        if evaluateEvery and i % evaluateEvery == evaluateEvery - 1:
+            result = evaluate(brain, [maps], repeats=4, jitter=(5, 10), maxSteps=maxSteps, frameSkip=frameSkip, patience=300)
+            print("Evaluation: ", i, "\tCompletion: ", result['completionRate'], "\tGates: ", result['gatesReached'], "\tSteps to finish: ", result['stepsToFinish'])
 
-brain.save('./car_model.pt')
-x = [i + 1 for i in range(episodes)]
-plt.plot(x, scores)
-plt.show()
\ No newline at end of file
+        if profile and i % profileEvery == profileEvery - 1:
+            print(profiler.report())
+            profiler.reset()
+
+    brain.close()
+    if recorder is not None:
+        recorder.close()
+    return brain, scores, times
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    episodes = 1
+    brain, scores, times = train(episodes)
+
+    brain.save('./car_model.pt')
+    x = [i + 1 for i in range(episodes)]
+    plt.plot(x, scores)
+    plt.show()
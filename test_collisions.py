@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from Environment import Game, compareCollisions
+
+# The footprint box stands in for the masks in VecGame, Evaluate and the 'box' and 'swept' games, so it has to see
+# the same crashes: at the crash pose itself, and first touching a wall no more than a few steps before the masks
+def test_box_agrees_with_masks_on_crashes():
+    result = compareCollisions(episodes=100, seed=0)
+    assert result['crashes'] >= 50
+    assert result['atCrash'] >= 0.9
+    onTime = [k is not None and k <= 3 for k in result['stepsEarly']]
+    assert np.mean(onTime) >= 0.9
+
+def test_collision_models():
+    assert Game(headless=True, collision='geometric').collision == 'box'
+    with pytest.raises(ValueError):
+        Game(headless=True, collision='typo')
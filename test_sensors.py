@@ -0,0 +1,8 @@
+from Environment import compareSensors
+
+# The default sensor table has to read like casting the rays against every wall, on the steps the car drives
+def test_sensor_table_matches_raycasting(tmp_path):
+    result = compareSensors(steps=1000, sensorTable={'cache': str(tmp_path)})
+    assert result['median'] < 0.5
+    assert result['raysOff10Percent'] < 0.02
+    assert result['stepsOff50'] < 0.1